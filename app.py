@@ -1,18 +1,46 @@
+from __future__ import annotations
+
+import time
+
+# startup is measured from here; see STARTUP_SECONDS
+_IMPORT_STARTED = time.perf_counter()
+
 import os
 import json
+import contextlib
+import contextvars
+import collections
+import datetime
+import re
+import random
+import sqlite3
+import functools
+import itertools
+import unicodedata
+import urllib.parse
 import uuid
-import requests
-from bs4 import BeautifulSoup
-from flask import Flask, redirect, render_template, request, session, url_for
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import Flow
-from googleapiclient.discovery import build
+import queue
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import TYPE_CHECKING
+from flask import Flask, Response, abort, jsonify, redirect, render_template, request, session, url_for
+from google.auth.exceptions import RefreshError
 from googleapiclient.errors import HttpError
-from googleapiclient.http import BatchHttpRequest
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+# The HTTP clients, OAuth flow and discovery client take several hundred
+# milliseconds to import, so they are imported where they are first used
+# (and by warm_up() once a worker is serving) to keep cold starts fast.
+if TYPE_CHECKING:
+    import httplib2
+    import requests
+    from google.oauth2.credentials import Credentials
+    from google_auth_httplib2 import AuthorizedHttp
 
 # --- Flask App Configuration ---
 app = Flask(__name__)
 app.secret_key = os.environ.get("FLASK_SECRET_KEY", "super-secret-key-for-dev")
+app.logger.setLevel(os.environ.get("LOG_LEVEL", "INFO"))
 # Allow OAuth on http://localhost for testing
 os.environ["OAUTHLIB_INSECURE_TRANSPORT"] = "1"
 
@@ -20,6 +48,135 @@ os.environ["OAUTHLIB_INSECURE_TRANSPORT"] = "1"
 SCOPES = ["https://www.googleapis.com/auth/youtube.force-ssl"]
 API_SERVICE_NAME = "youtube"
 API_VERSION = "v3"
+# Send YouTube Data API calls to another host, e.g. the fake API in bench/
+YOUTUBE_API_ROOT = os.environ.get("YOUTUBE_API_ROOT")
+
+# --- Credential Store Configuration ---
+# signed-in users whose credentials and API client are kept in memory
+CREDENTIAL_STORE_MAX_USERS = int(os.environ.get("CREDENTIAL_STORE_MAX_USERS", 1000))
+CREDENTIAL_IDLE_SECONDS = int(os.environ.get("CREDENTIAL_IDLE_SECONDS", 24 * 3600))
+# refresh access tokens this long before they expire
+TOKEN_REFRESH_MARGIN_SECONDS = int(os.environ.get("TOKEN_REFRESH_MARGIN_SECONDS", 300))
+TOKEN_REFRESH_INTERVAL_SECONDS = int(os.environ.get("TOKEN_REFRESH_INTERVAL_SECONDS", 60))
+
+# --- Bulk Migration Configuration ---
+BULK_MAX_PLAYLISTS = int(os.environ.get("BULK_MAX_PLAYLISTS", 100))
+# Worker threads per pipeline stage, and how many playlists may wait between stages
+BULK_SCRAPE_WORKERS = int(os.environ.get("BULK_SCRAPE_WORKERS", 4))
+BULK_RESOLVE_WORKERS = int(os.environ.get("BULK_RESOLVE_WORKERS", 2))
+BULK_INSERT_WORKERS = int(os.environ.get("BULK_INSERT_WORKERS", 2))
+BULK_QUEUE_SIZE = int(os.environ.get("BULK_QUEUE_SIZE", 4))
+
+# --- HTTP Configuration ---
+# Keep-alive connections per host for the shared Apple Music session
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", 32))
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", 30))
+USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+    "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+)
+
+# --- Background Job Configuration ---
+MIGRATION_WORKERS = int(os.environ.get("MIGRATION_WORKERS", 4))
+# Migrations that may wait for a worker beyond those running; more are turned away
+MAX_QUEUED_MIGRATIONS = int(os.environ.get("MAX_QUEUED_MIGRATIONS", 32))
+# Migrations one user may have queued or running at once
+MAX_USER_MIGRATIONS = int(os.environ.get("MAX_USER_MIGRATIONS", 2))
+# Seconds a turned-away client is asked to wait before trying again
+ADMISSION_RETRY_AFTER = int(os.environ.get("ADMISSION_RETRY_AFTER", 60))
+JOB_RETENTION_SECONDS = int(os.environ.get("JOB_RETENTION_SECONDS", 3600))
+# Searches one migration may have in flight, and threads shared by all migrations
+SEARCH_CONCURRENCY = int(os.environ.get("SEARCH_CONCURRENCY", 8))
+SEARCH_WORKERS = int(os.environ.get("SEARCH_WORKERS", 32))
+# Tracks a migration may have resolved ahead of the next one it inserts
+RESOLVE_WINDOW = int(os.environ.get("RESOLVE_WINDOW", 256))
+
+# --- Quota Configuration ---
+# Units the API project may spend per day, and how much of it may be spent in a burst.
+# The rest refills evenly over the day, so with the default 10,000 unit quota half of
+# it (50 searches) is available at once and then one search's worth every ~29 minutes.
+# Projects granted a larger quota should raise YOUTUBE_DAILY_QUOTA to match.
+YOUTUBE_DAILY_QUOTA = int(os.environ.get("YOUTUBE_DAILY_QUOTA", 10_000))
+QUOTA_BURST = int(os.environ.get("QUOTA_BURST", YOUTUBE_DAILY_QUOTA // 2))
+# Longest a call is held waiting for quota before it is given up on. Past the burst
+# calls fail with QuotaExhausted instead of holding a worker for the refill, and
+# the migration finishes with the tracks it managed to add.
+QUOTA_MAX_WAIT_SECONDS = float(os.environ.get("QUOTA_MAX_WAIT_SECONDS", 600))
+API_MAX_RETRIES = int(os.environ.get("API_MAX_RETRIES", 5))
+# Unit cost of each API method we call; anything unlisted costs 1
+QUOTA_COSTS = {
+    "youtube.search.list": 100,
+    "youtube.playlists.insert": 50,
+    "youtube.playlistItems.insert": 50,
+    "youtube.playlistItems.list": 1,
+    "youtube.videos.list": 1,
+}
+RETRYABLE_403_REASONS = {"quotaExceeded", "rateLimitExceeded", "userRateLimitExceeded"}
+# Read-only methods, safe to send again after a connection failure; a resent insert could add a duplicate
+READ_ONLY_METHODS = {"youtube.search.list", "youtube.videos.list", "youtube.playlistItems.list"}
+
+# --- Match Configuration ---
+# Candidates fetched per search; search.list costs 100 units however many it returns
+SEARCH_CANDIDATES = int(os.environ.get("SEARCH_CANDIDATES", 5))
+# A match scoring at least this (out of 1) is reused for other tracks with the same ISRC
+MATCH_CONFIDENT_SCORE = float(os.environ.get("MATCH_CONFIDENT_SCORE", 0.75))
+# A candidate's duration stops counting in its favour this many seconds away from the track's
+MATCH_DURATION_TOLERANCE = float(os.environ.get("MATCH_DURATION_TOLERANCE", 30))
+
+# --- Insert Configuration ---
+BATCH_SIZE = 50  # inserts checkpointed and reported together
+INSERT_MAX_ROUNDS = int(os.environ.get("INSERT_MAX_ROUNDS", 3))
+
+# --- Cache Configuration ---
+# Point CACHE_DB_PATH at a mounted volume to keep the cache across container restarts
+CACHE_DB_PATH = os.environ.get("CACHE_DB_PATH", "/tmp/migrator-cache.sqlite3")
+RESOLUTION_CACHE_TTL = int(os.environ.get("RESOLUTION_CACHE_TTL", 30 * 24 * 3600))
+RESOLUTION_CACHE_MAX_ENTRIES = int(os.environ.get("RESOLUTION_CACHE_MAX_ENTRIES", 200_000))
+SCRAPE_CACHE_TTL = int(os.environ.get("SCRAPE_CACHE_TTL", 7 * 24 * 3600))
+SCRAPE_CACHE_MAX_ENTRIES = int(os.environ.get("SCRAPE_CACHE_MAX_ENTRIES", 5_000))
+
+# --- Metrics ---
+
+STAGE_SECONDS = Histogram(
+    "migrator_stage_seconds",
+    "Time spent in each migration stage.",
+    ["stage"],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+QUOTA_UNITS = Counter("migrator_quota_units_total", "YouTube API quota units spent.", ["method"])
+JOB_QUOTA_UNITS = Histogram(
+    "migrator_job_quota_units",
+    "YouTube API quota units spent per migration job.",
+    buckets=(100, 500, 1_000, 2_500, 5_000, 10_000, 25_000, 50_000, 100_000),
+)
+CACHE_REQUESTS = Counter("migrator_cache_requests_total", "Cache lookups.", ["cache", "result"])
+COALESCED_SEARCHES = Counter(
+    "migrator_coalesced_searches_total", "Track searches that joined an identical search already in flight."
+)
+JOBS_IN_FLIGHT = Gauge("migrator_jobs_in_flight", "Migration jobs currently running.")
+JOBS_FINISHED = Counter("migrator_jobs_total", "Migration jobs finished.", ["status"])
+STARTUP_SECONDS = Gauge(
+    "migrator_startup_seconds", "Seconds spent in each startup phase of this process.", ["phase"]
+)
+TOKEN_REFRESHES = Counter("migrator_token_refreshes_total", "Background OAuth token refreshes.", ["result"])
+
+# the job whose work the current thread is doing, for per-job accounting
+_current_job = contextvars.ContextVar("current_job", default=None)
+
+
+@contextlib.contextmanager
+def timed(stage: str):
+    """Observe the block's duration in STAGE_SECONDS and the current job's timings."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.labels(stage).observe(elapsed)
+        job = _current_job.get()
+        if job:
+            job.add_timing(stage, elapsed)
+
 
 # --- Helper Functions ---
 
@@ -32,60 +189,1736 @@ def get_client_config():
         )
     return json.loads(config_str)
 
-def credentials_to_dict(creds: Credentials) -> dict:
-    """Serialize OAuth2 credentials to store in the Flask session."""
-    return {
-        "token": creds.token,
-        "refresh_token": creds.refresh_token,
-        "token_uri": creds.token_uri,
-        "client_id": creds.client_id,
-        "client_secret": creds.client_secret,
-        "scopes": creds.scopes,
-    }
 
-def scrape_apple_music_playlist(url: str):
-    """Fetch an Apple Music playlist and extract track titles + artists."""
-    headers = {
-        "User-Agent": (
-            "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-            "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+def oauth_flow(redirect_uri: str, state: str = None):
+    """Build the OAuth consent flow that returns the user to redirect_uri."""
+    from google_auth_oauthlib.flow import Flow
+
+    flow = Flow.from_client_config(get_client_config(), SCOPES, state=state)
+    flow.redirect_uri = redirect_uri
+    return flow
+
+_SCRIPT_OPEN = re.compile(rb"<script\b([^>]*)>", re.IGNORECASE)
+_SCRIPT_CLOSE = re.compile(rb"</script\s*>", re.IGNORECASE)
+_SERIALIZED_DATA_ATTR = re.compile(rb"""\bid\s*=\s*["']?serialized-server-data\b""", re.IGNORECASE)
+_JSON_TYPE_ATTR = re.compile(rb"""\btype\s*=\s*["']?application/json\b""", re.IGNORECASE)
+
+
+class EmbeddedJsonScanner:
+    """Finds the page's embedded playlist <script> in HTML fed to it chunk by chunk.
+
+    Scans for <script> tags without building a DOM, buffering only the tag
+    currently being read. The script with id="serialized-server-data" wins
+    as soon as it is complete; otherwise the first type="application/json"
+    script seen is kept in `fallback`.
+    """
+
+    def __init__(self):
+        self.fallback = None
+        self._buf = bytearray()
+        self._attrs = None  # attributes of the <script> whose body is being read
+        self._scanned = 0  # how much of _buf is known not to contain the closing tag
+
+    def feed(self, chunk: bytes):
+        """Consume the next chunk; return the serialized data script's body once it is complete."""
+        buf = self._buf
+        buf += chunk
+        while True:
+            if self._attrs is None:
+                m = _SCRIPT_OPEN.search(buf)
+                if not m:
+                    # keep what may be the start of a tag split across chunks
+                    cut = buf.rfind(b"<")
+                    del buf[:cut if cut != -1 else len(buf)]
+                    return None
+                self._attrs = m.group(1)
+                del buf[:m.end()]
+                self._scanned = 0
+            m = _SCRIPT_CLOSE.search(buf, max(self._scanned - 16, 0))
+            if not m:
+                self._scanned = len(buf)
+                return None
+            body = bytes(buf[:m.start()])
+            del buf[:m.end()]
+            if _SERIALIZED_DATA_ATTR.search(self._attrs):
+                return body
+            if self.fallback is None and _JSON_TYPE_ATTR.search(self._attrs):
+                self.fallback = body
+            self._attrs = None
+
+
+def find_embedded_json(chunks):
+    """Return the body of the page's embedded playlist <script> from a stream of HTML chunks, or None."""
+    scanner = EmbeddedJsonScanner()
+    for chunk in chunks:
+        body = scanner.feed(chunk)
+        if body is not None:
+            return body
+    return scanner.fallback
+
+
+class Track:
+    """One playlist track, holding only what a migration uses.
+
+    A 10k track playlist is held as 10k of these rather than as the page's
+    JSON objects, which also carry artwork, offers and the like.
+    """
+
+    __slots__ = ("title", "artist", "album", "duration_ms", "isrc")
+
+    def __init__(self, title: str, artist: str, album: str = None, duration_ms: int = None, isrc: str = None):
+        self.title = title
+        self.artist = artist
+        self.album = album
+        self.duration_ms = duration_ms
+        self.isrc = isrc
+
+    @classmethod
+    def from_item(cls, item: dict) -> Track:
+        """Build a Track from one item of a trackLockup section."""
+        return cls(
+            item.get("title", "Unknown Title"),
+            item.get("artistName", "Unknown Artist"),
+            item.get("albumName"),
+            item.get("duration"),
+            item.get("isrc"),
         )
-    }
-    try:
-        resp = requests.get(url, headers=headers)
-        resp.raise_for_status()
-        soup = BeautifulSoup(resp.text, "html.parser")
-
-        # look for the serialized data script (may change over time)
-        script = soup.find("script", id="serialized-server-data") or soup.find("script", {"type": "application/json"})
-        if not script or not script.string:
-            return None, "Could not locate embedded playlist data."
-
-        data = json.loads(script.string)
-        # adjust navigation to actual JSON shape if needed
-        playlist_info = data[0]["data"]
-        playlist_name = playlist_info.get("name", "Apple Music Playlist")
-        items = []
-        for section in playlist_info.get("sections", []):
-            if section.get("itemKind") == "trackLockup":
-                items.extend(section.get("items", []))
 
-        tracks = [
-            f"{t.get('title','Unknown Title')} by {t.get('artistName','Unknown Artist')}"
-            for t in items
-        ]
-        return playlist_name, tracks
+    @property
+    def query(self) -> str:
+        """The YouTube search for this track, also used to name it in messages."""
+        return f"{self.title} by {self.artist}"
+
+    @property
+    def key(self) -> str:
+        """The track's key in the resolution cache and sync checkpoints."""
+        return normalize_query(self.query)
+
+    def to_row(self) -> list:
+        return [self.title, self.artist, self.album, self.duration_ms, self.isrc]
+
+    @classmethod
+    def from_row(cls, row: list) -> Track:
+        return cls(*row)
+
+    def __repr__(self):
+        return f"Track({self.query!r})"
+
+
+def _compact_track_item(obj: dict):
+    # track items become Tracks as soon as they are decoded, so their full
+    # JSON never accumulates; items elsewhere on the page are skipped later
+    return Track.from_item(obj) if "artistName" in obj else obj
+
+
+def parse_embedded_playlist(body: bytes) -> dict:
+    """Decode the playlist object from the embedded JSON.
+
+    The script holds a JSON array whose first element carries the playlist;
+    only that element is decoded and the rest of the array is skipped.
+    Track items are decoded straight into Tracks.
+    """
+    text = body.decode("utf-8")
+    start = text.index("[") + 1
+    while text[start].isspace():
+        start += 1
+    first, _ = json.JSONDecoder(object_hook=_compact_track_item).raw_decode(text, start)
+    # adjust navigation to actual JSON shape if needed
+    return first["data"]
+
+
+def iter_playlist_tracks(playlist_info: dict):
+    """Yield a Track for each item in the playlist's track sections."""
+    for section in playlist_info.get("sections", []):
+        if section.get("itemKind") == "trackLockup":
+            for t in section.get("items", []):
+                yield t if isinstance(t, Track) else Track.from_item(t)
+
+
+@functools.lru_cache(maxsize=None)
+def get_http_session() -> requests.Session:
+    """The process-wide requests session, so scrapes reuse keep-alive connections."""
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    http_session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+    http_session.mount("https://", adapter)
+    http_session.mount("http://", adapter)
+    http_session.headers["User-Agent"] = USER_AGENT
+    return http_session
+
+
+def scrape_apple_music_playlist(url: str):
+    """Fetch an Apple Music playlist and extract track titles + artists.
+
+    A previously scraped playlist is revalidated with its ETag and
+    Last-Modified; on 304 Not Modified the cached result is returned
+    without downloading or parsing the page.
+    """
+    import requests
+
+    key, cached, headers = scrape_revalidation(url)
+    try:
+        with timed("scrape_fetch"), \
+                get_http_session().get(url, headers=headers, stream=True, timeout=HTTP_TIMEOUT) as resp:
+            if resp.status_code == 304 and cached:
+                return scrape_not_modified(key, cached)
+            CACHE_REQUESTS.labels("scrape", "miss").inc()
+            resp.raise_for_status()
+            validators = resp.headers.get("ETag"), resp.headers.get("Last-Modified")
+            # look for the serialized data script (may change over time)
+            body = find_embedded_json(resp.iter_content(chunk_size=64 * 1024))
+        return finish_scrape(key, body, validators)
 
     except requests.RequestException as e:
         return None, f"Network error: {e}"
     except (ValueError, KeyError, IndexError, TypeError) as e:
         return None, f"Parsing error: {e}"
-    
-def callback(request_id, response, exception):
-    if exception:
-        print(f"Error for request {request_id}: {exception}")
+
+
+def scrape_revalidation(url: str):
+    """Return (cache key, cached scrape or None, conditional request headers) for url."""
+    key = canonical_playlist_url(url)
+    cached = get_scrape_cache().get(key)
+    headers = {}
+    if cached and cached["etag"]:
+        headers["If-None-Match"] = cached["etag"]
+    if cached and cached["last_modified"]:
+        headers["If-Modified-Since"] = cached["last_modified"]
+    return key, cached, headers
+
+
+def scrape_not_modified(key: str, cached: dict):
+    """Answer a 304 from the cached scrape, renewing its TTL."""
+    CACHE_REQUESTS.labels("scrape", "hit").inc()
+    get_scrape_cache().set(key, cached)
+    return cached["name"], [Track.from_row(row) for row in cached["tracks"]]
+
+
+def finish_scrape(key: str, body: bytes, validators: tuple):
+    """Parse the embedded JSON into (playlist name, tracks), caching it when the page had validators."""
+    if not body:
+        return None, "Could not locate embedded playlist data."
+
+    with timed("scrape_parse"):
+        playlist_info = parse_embedded_playlist(body)
+        playlist_name = playlist_info.get("name", "Apple Music Playlist")
+        tracks = list(iter_playlist_tracks(playlist_info))
+    if any(validators):
+        get_scrape_cache().set(key, {
+            "name": playlist_name,
+            "tracks": [t.to_row() for t in tracks],
+            "etag": validators[0],
+            "last_modified": validators[1],
+        })
+    return playlist_name, tracks
+
+
+class MigrationError(Exception):
+    """A migration failure that should be shown to the user as-is."""
+
+
+class QuotaExhausted(MigrationError):
+    """The YouTube quota budget cannot cover a call within QUOTA_MAX_WAIT_SECONDS."""
+
+
+class MigrationRejected(MigrationError):
+    """Admission control turned a new migration away.
+
+    job is set when the user already has the same playlist in flight.
+    """
+
+    def __init__(self, message: str, retry_after: int = None, job=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.job = job
+
+
+# --- Caches ---
+
+def _connect_db(path: str) -> sqlite3.Connection:
+    """Open an autocommit connection that may be shared by threads (callers lock around it)."""
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+
+class PersistentCache:
+    """A SQLite-backed key/value cache with a TTL and a least-recently-used size cap.
+
+    Values are stored as JSON. One connection is shared by all threads and
+    guarded by a lock; expired and surplus rows are evicted every
+    EVICT_EVERY writes rather than on each one.
+    """
+
+    EVICT_EVERY = 256
+
+    def __init__(self, path: str, table: str, ttl: int, max_entries: int):
+        self.table = table
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._conn = _connect_db(path)
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, stored_at REAL NOT NULL, used_at REAL NOT NULL)"
+        )
+        self._conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_used_at ON {table} (used_at)")
+
+    def get(self, key: str, default=None):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT value, stored_at FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return default
+            if now - row[1] > self.ttl:
+                self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                return default
+            self._conn.execute(f"UPDATE {self.table} SET used_at = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def set(self, key: str, value):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, stored_at, used_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now),
+            )
+            self._writes += 1
+            if self._writes % self.EVICT_EVERY == 0:
+                self._evict(now)
+
+    def _evict(self, now: float):
+        """Drop expired rows, then the least recently used beyond max_entries. Caller holds _lock."""
+        self._conn.execute(f"DELETE FROM {self.table} WHERE stored_at < ?", (now - self.ttl,))
+        self._conn.execute(
+            f"DELETE FROM {self.table} WHERE key IN ("
+            f"SELECT key FROM {self.table} ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+
+
+class SyncCheckpoint:
+    """Which Apple Music tracks have been added to which YouTube playlist, and as what video.
+
+    Rows are written as each insert batch commits, so an interrupted
+    migration or sync picks up where it stopped on the next run.
+    """
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = _connect_db(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sync_state ("
+            "playlist_id TEXT NOT NULL, track_key TEXT NOT NULL, video_id TEXT NOT NULL, "
+            "synced_at REAL NOT NULL, PRIMARY KEY (playlist_id, track_key))"
+        )
+
+    def load(self, playlist_id: str) -> dict:
+        """Return {track key: videoId} for everything recorded against playlist_id."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT track_key, video_id FROM sync_state WHERE playlist_id = ?", (playlist_id,)
+            ).fetchall()
+        return dict(rows)
+
+    def record(self, playlist_id: str, entries: list):
+        """Record (track key, videoId) pairs as present in playlist_id."""
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO sync_state (playlist_id, track_key, video_id, synced_at) "
+                "VALUES (?, ?, ?, ?)",
+                [(playlist_id, key, video_id, now) for key, video_id in entries],
+            )
+
+
+@functools.lru_cache(maxsize=None)
+def get_sync_checkpoint() -> SyncCheckpoint:
+    return SyncCheckpoint(CACHE_DB_PATH)
+
+
+@functools.lru_cache(maxsize=None)
+def get_resolution_cache() -> PersistentCache:
+    """The process-wide track -> videoId cache (a cached None means no match)."""
+    return PersistentCache(
+        CACHE_DB_PATH, "resolutions", RESOLUTION_CACHE_TTL, RESOLUTION_CACHE_MAX_ENTRIES
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_scrape_cache() -> PersistentCache:
+    """The process-wide cache of scraped playlists and their HTTP validators."""
+    # v2 rows hold Track.to_row() lists rather than "Title by Artist" strings
+    return PersistentCache(CACHE_DB_PATH, "scrapes_v2", SCRAPE_CACHE_TTL, SCRAPE_CACHE_MAX_ENTRIES)
+
+
+def canonical_playlist_url(url: str) -> str:
+    """Scrape cache key: scheme and host lowercased, query, fragment and trailing slash dropped."""
+    parts = urllib.parse.urlsplit(url.strip())
+    return urllib.parse.urlunsplit(
+        (parts.scheme.lower(), parts.netloc.lower(), parts.path.rstrip("/"), "", "")
+    )
+
+
+def parse_playlist_id(value: str) -> str:
+    """Accept a YouTube playlist id or any URL carrying it in ?list=."""
+    value = value.strip()
+    query = urllib.parse.parse_qs(urllib.parse.urlsplit(value).query)
+    return query["list"][0] if "list" in query else value
+
+
+def normalize_query(query: str) -> str:
+    """Cache key for a "Title by Artist" query: case, width and spacing folded."""
+    return " ".join(unicodedata.normalize("NFKC", query).casefold().split())
+
+
+# --- Quota Scheduling ---
+
+class QuotaScheduler:
+    """Token bucket that paces YouTube API spending across the day.
+
+    The bucket holds at most `burst` units and refills continuously so that
+    burst plus a day's refill equals the daily quota; no 24 hour window can
+    spend more than the project is allowed. A call that finds too few units
+    is held until enough have refilled, or fails with QuotaExhausted straight
+    away if that would take longer than max_wait.
+    """
+
+    def __init__(self, daily_quota: int, burst: int, max_wait: float):
+        self.capacity = min(burst, daily_quota)
+        self.rate = max(daily_quota - self.capacity, 1) / 86400
+        self.max_wait = max_wait
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, cost: int) -> float:
+        """Take cost units now and return how many seconds the caller must wait before using them.
+
+        The bucket may go into debt, which queues callers in arrival order;
+        a reservation that would wait longer than max_wait is not taken.
+        """
+        if cost > self.capacity:
+            raise QuotaExhausted(f"A {cost} unit call exceeds the {self.capacity} unit quota burst.")
+        with self._lock:
+            self._refill(time.monotonic())
+            wait_for = max(cost - self._tokens, 0) / self.rate
+            if wait_for > self.max_wait:
+                raise QuotaExhausted("YouTube API quota exhausted; please try again later.")
+            self._tokens -= cost
+            return wait_for
+
+    def drain(self):
+        """Empty the bucket after the API itself reports the quota as spent."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self._tokens, 0.0)
+
+
+@functools.lru_cache(maxsize=None)
+def get_quota_scheduler() -> QuotaScheduler:
+    return QuotaScheduler(YOUTUBE_DAILY_QUOTA, QUOTA_BURST, QUOTA_MAX_WAIT_SECONDS)
+
+
+def reserve_quota(method_id: str) -> float:
+    """Reserve one call's units, count them against the current job and return the seconds to wait."""
+    cost = QUOTA_COSTS.get(method_id, 1)
+    wait_for = get_quota_scheduler().reserve(cost)
+    QUOTA_UNITS.labels(method_id).inc(cost)
+    job = _current_job.get()
+    if job:
+        job.add_quota(cost)
+    return wait_for
+
+
+def spend_quota(method_id: str):
+    """Take one call's units from the scheduler, holding the thread until they are available."""
+    time.sleep(reserve_quota(method_id))
+
+
+def _error_reasons(error: HttpError) -> set:
+    details = error.error_details if isinstance(error.error_details, list) else []
+    return {d.get("reason") for d in details if isinstance(d, dict)}
+
+
+def _is_retryable(error: HttpError) -> bool:
+    status = error.resp.status
+    if status == 429 or status >= 500:
+        return True
+    return status == 403 and bool(_error_reasons(error) & RETRYABLE_403_REASONS)
+
+
+def backoff(attempt: int, base: float = 1.0, cap: float = 60.0) -> float:
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def transport_errors() -> tuple:
+    """The exceptions a dropped connection, timeout or DNS failure raises from the API transport."""
+    import httplib2
+
+    return OSError, httplib2.HttpLib2Error
+
+
+def retry_delay(error: HttpError, attempt: int):
+    """Return how long to back off before retrying a failed call, or None to give up."""
+    if attempt == API_MAX_RETRIES or not _is_retryable(error):
+        return None
+    if "quotaExceeded" in _error_reasons(error):
+        get_quota_scheduler().drain()
+    return backoff(attempt)
+
+
+def call_with_quota(method_id: str, fn):
+    """Run one API call under the quota scheduler, retrying transient failures."""
+    for attempt in range(API_MAX_RETRIES + 1):
+        spend_quota(method_id)
+        try:
+            return fn()
+        except HttpError as e:
+            delay = retry_delay(e, attempt)
+            if delay is None:
+                raise
+            time.sleep(delay)
+        except transport_errors():
+            if attempt == API_MAX_RETRIES or method_id not in READ_ONLY_METHODS:
+                raise
+            time.sleep(backoff(attempt))
+
+
+# --- YouTube Client ---
+
+_thread_local = threading.local()
+
+
+def _thread_http() -> httplib2.Http:
+    """Return this thread's Google API transport.
+
+    httplib2.Http must not be shared across threads, but it keeps its
+    connections alive, so each thread holds one for the life of the process
+    and every user's requests on that thread reuse it.
+    """
+    http = getattr(_thread_local, "http", None)
+    if http is None:
+        import httplib2
+
+        http = _thread_local.http = httplib2.Http(timeout=HTTP_TIMEOUT)
+    return http
+
+
+def _thread_authorized_http(credentials) -> AuthorizedHttp:
+    from google_auth_httplib2 import AuthorizedHttp
+
+    return AuthorizedHttp(credentials, http=_thread_http())
+
+
+@functools.lru_cache(maxsize=None)
+def _youtube_request_class():
+    """Define YouTubeRequest on first use, as its base class is one of the slow imports."""
+    from googleapiclient.http import HttpRequest
+
+    class YouTubeRequest(HttpRequest):
+        """HttpRequest that is paced by the quota scheduler and safe to run from any thread.
+
+        A discovery-built client shares one httplib2.Http between every
+        request it creates, so requests executed from the search pool would
+        otherwise race on the same connection; each execute() uses the calling
+        thread's own transport instead.
+        """
+
+        def execute(self, http=None, num_retries=0):
+            if http is None:
+                http = _thread_authorized_http(self.http.credentials)
+            return call_with_quota(
+                self.methodId, lambda: super(YouTubeRequest, self).execute(http=http, num_retries=num_retries)
+            )
+
+    return YouTubeRequest
+
+
+@functools.lru_cache(maxsize=None)
+def _discovery_document() -> dict:
+    """The YouTube discovery document bundled with google-api-python-client, parsed once."""
+    from googleapiclient import discovery_cache
+
+    document = json.loads(discovery_cache.get_static_doc(API_SERVICE_NAME, API_VERSION))
+    if YOUTUBE_API_ROOT:
+        # rootUrl also places the batch endpoint, which client_options cannot move
+        document["rootUrl"] = YOUTUBE_API_ROOT.rstrip("/") + "/"
+    return document
+
+
+def build_youtube(creds: Credentials):
+    """Build a YouTube client whose every call goes through YouTubeRequest.
+
+    Building from the cached discovery document skips reading and parsing
+    it for every client, and the requests run on the shared per-thread
+    transports, so a client per user is cheap.
+    """
+    from googleapiclient.discovery import build_from_document
+
+    return build_from_document(_discovery_document(), credentials=creds, requestBuilder=_youtube_request_class())
+
+
+# --- Credential Store ---
+
+class CredentialStore:
+    """Signed-in users' OAuth credentials and YouTube clients, kept server-side.
+
+    The session cookie only carries an opaque user id. Users are dropped
+    least recently used first beyond max_users, or after max_idle seconds
+    unused, and simply sign in again. A background thread refreshes access
+    tokens shortly before they expire, so a migration never waits on a
+    token round-trip or on building a client.
+    """
+
+    def __init__(self, max_users: int, max_idle: int, refresh_margin: int):
+        self.max_users = max_users
+        self.max_idle = max_idle
+        self.refresh_margin = datetime.timedelta(seconds=refresh_margin)
+        self._entries = collections.OrderedDict()  # user id -> [creds, youtube, last used], oldest first
+        self._lock = threading.Lock()
+        self._refresher = None
+
+    def put(self, user_id: str, creds: Credentials):
+        youtube = build_youtube(creds)
+        now = time.time()
+        with self._lock:
+            self._entries[user_id] = [creds, youtube, now]
+            self._entries.move_to_end(user_id)
+            self._evict(now)
+        self._ensure_refresher()
+
+    def client(self, user_id: str):
+        """Return the user's YouTube client, or None if they need to sign in again."""
+        entry = self._touch(user_id)
+        return entry[1] if entry else None
+
+    def credentials(self, user_id: str):
+        """Return the user's Credentials, or None if they need to sign in again."""
+        entry = self._touch(user_id)
+        return entry[0] if entry else None
+
+    def _touch(self, user_id: str):
+        now = time.time()
+        with self._lock:
+            self._evict(now)
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                entry[2] = now
+                self._entries.move_to_end(user_id)
+            return entry
+
+    def discard(self, user_id: str):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def _evict(self, now: float):
+        """Drop idle users and the least recently used beyond max_users. Caller holds _lock."""
+        while self._entries:
+            user_id, (_, _, last_used) = next(iter(self._entries.items()))
+            if len(self._entries) <= self.max_users and last_used >= now - self.max_idle:
+                break
+            del self._entries[user_id]
+
+    def refresh_due(self):
+        """Refresh every stored access token that expires within refresh_margin."""
+        # Credentials.expiry is a naive UTC datetime
+        deadline = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None) + self.refresh_margin
+        with self._lock:
+            due = [
+                (user_id, creds) for user_id, (creds, _, _) in self._entries.items()
+                if creds.refresh_token and creds.expiry and creds.expiry <= deadline
+            ]
+        for user_id, creds in due:
+            try:
+                from google.auth.transport.requests import Request as GoogleAuthRequest
+
+                creds.refresh(GoogleAuthRequest(get_http_session()))
+                TOKEN_REFRESHES.labels("ok").inc()
+            except RefreshError as e:
+                # revoked or expired grant: the user has to consent again
+                app.logger.warning("Dropping credentials for user %s: %s", user_id, e)
+                self.discard(user_id)
+                TOKEN_REFRESHES.labels("rejected").inc()
+            except Exception:
+                app.logger.exception("Token refresh for user %s failed; will retry", user_id)
+                TOKEN_REFRESHES.labels("error").inc()
+
+    def _ensure_refresher(self):
+        with self._lock:
+            if self._refresher is None or not self._refresher.is_alive():
+                self._refresher = threading.Thread(target=self._refresh_loop, name="token-refresher", daemon=True)
+                self._refresher.start()
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(TOKEN_REFRESH_INTERVAL_SECONDS)
+            try:
+                self.refresh_due()
+            except Exception:
+                app.logger.exception("Token refresher pass failed")
+
+
+@functools.lru_cache(maxsize=None)
+def get_credential_store() -> CredentialStore:
+    return CredentialStore(CREDENTIAL_STORE_MAX_USERS, CREDENTIAL_IDLE_SECONDS, TOKEN_REFRESH_MARGIN_SECONDS)
+
+
+_search_executor = ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix="search")
+
+
+# --- Match Engine ---
+
+# partial responses: only what scoring needs comes back
+SEARCH_FIELDS = "items(id/videoId,snippet(title,channelTitle))"
+VIDEO_FIELDS = "items(id,contentDetails/duration)"
+
+_WORDS = re.compile(r"\w+")
+_ISO_DURATION = re.compile(r"P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?")
+# words that mark a video as something other than the recording, unless the track's title has them too
+_VARIANT_WORDS = {"cover", "live", "karaoke", "instrumental", "remix", "reaction", "nightcore", "slowed", "tutorial"}
+
+
+def _words(text: str) -> set:
+    return set(_WORDS.findall(text.casefold()))
+
+
+def _overlap(wanted: set, candidates: list) -> list:
+    """The fraction of wanted's words found in each of the candidates' word sets."""
+    if not wanted:
+        return [0.0] * len(candidates)
+    return [len(wanted & words) / len(wanted) for words in candidates]
+
+
+def parse_iso_duration(value: str):
+    """Milliseconds in an ISO 8601 duration such as PT4M13S, or None."""
+    m = _ISO_DURATION.fullmatch(value or "")
+    if not m or not any(m.groups()):
+        return None
+    days, hours, minutes, seconds = (int(g or 0) for g in m.groups())
+    return (((days * 24 + hours) * 60 + minutes) * 60 + seconds) * 1000
+
+
+def parse_candidates(search_resp: dict) -> list:
+    """The search.list response as a list of {"video_id", "title", "channel"} dicts."""
+    return [
+        {
+            "video_id": item["id"]["videoId"],
+            "title": item.get("snippet", {}).get("title", ""),
+            "channel": item.get("snippet", {}).get("channelTitle", ""),
+        }
+        for item in search_resp.get("items", [])
+        if item.get("id", {}).get("videoId")
+    ]
+
+
+def parse_durations(videos_resp: dict, video_ids: list) -> list:
+    """Durations in milliseconds from a videos.list response, in video_ids order (None if missing)."""
+    by_id = {item["id"]: item.get("contentDetails", {}).get("duration") for item in videos_resp.get("items", [])}
+    return [parse_iso_duration(by_id.get(vid)) for vid in video_ids]
+
+
+def score_candidates(track: Track, candidates: list, durations: list = None) -> list:
+    """Score each search candidate out of 1 as a match for track.
+
+    Each signal is worked out for the whole candidate list at once and the
+    columns are then combined: the share of the track's title words in the
+    video title, the share of its artist words in the channel name or title,
+    and, when both durations are known, how close the lengths are. Videos
+    whose titles flag a cover, live take, remix and so on lose half a point
+    unless the track's own title says the same.
+    """
+    titles = [_words(c["title"]) for c in candidates]
+    title_words, artist_words = _words(track.title), _words(track.artist)
+    columns = [
+        (0.5, _overlap(title_words, titles)),
+        (0.3, [max(a, b) for a, b in zip(
+            _overlap(artist_words, [_words(c["channel"]) for c in candidates]),
+            _overlap(artist_words, titles),
+        )]),
+    ]
+    if track.duration_ms and durations:
+        tolerance = MATCH_DURATION_TOLERANCE * 1000
+        columns.append((0.2, [
+            max(0.0, 1 - abs(d - track.duration_ms) / tolerance) if d else 0.0 for d in durations
+        ]))
+    total = sum(weight for weight, _ in columns)
+    penalties = [0.5 if (words - title_words) & _VARIANT_WORDS else 0.0 for words in titles]
+    return [
+        sum(weight * column[j] for weight, column in columns) / total - penalties[j]
+        for j in range(len(candidates))
+    ]
+
+
+def needs_verification(track: Track, scores: list) -> bool:
+    """Whether the candidates' durations are worth a videos.list call.
+
+    They are when the track's duration is known and title and artist alone
+    leave the best candidate short of MATCH_CONFIDENT_SCORE or within
+    0.2 of the runner-up.
+    """
+    if not track.duration_ms or not scores:
+        return False
+    top, runner_up = sorted(scores, reverse=True)[:2] if len(scores) > 1 else (scores[0], float("-inf"))
+    return top < MATCH_CONFIDENT_SCORE or top - runner_up < 0.2
+
+
+def best_candidate(track: Track, candidates: list, durations: list = None) -> tuple:
+    """Return (videoId, score) of the best scoring candidate, or (None, 0.0) when there are none."""
+    if not candidates:
+        return None, 0.0
+    scores = score_candidates(track, candidates, durations)
+    best = max(range(len(candidates)), key=scores.__getitem__)
+    return candidates[best]["video_id"], scores[best]
+
+
+def _isrc_key(isrc: str) -> str:
+    return f"isrc:{isrc.upper()}"
+
+
+def cached_match(cache: PersistentCache, track: Track, default=None):
+    """The cached videoId for track, which is None for a search that found nothing, or default.
+
+    A confident match made for another track with the same ISRC is used
+    first, so the same recording spelled differently is not searched again.
+    """
+    if track.isrc:
+        video_id = cache.get(_isrc_key(track.isrc))
+        if video_id:
+            return video_id
+    return cache.get(track.key, default)
+
+
+def record_match(track: Track, video_id: str, score: float):
+    """Store a search's answer for track in the resolution cache."""
+    cache = get_resolution_cache()
+    if video_id and track.isrc and score >= MATCH_CONFIDENT_SCORE:
+        cache.set(_isrc_key(track.isrc), video_id)
+    cache.set(track.key, video_id)
+
+
+def search_candidates(youtube, query: str) -> list:
+    """Return the top SEARCH_CANDIDATES search results for query as parse_candidates dicts."""
+    with timed("search"):
+        search_resp = youtube.search().list(
+            part="snippet", q=query, type="video", maxResults=SEARCH_CANDIDATES, fields=SEARCH_FIELDS
+        ).execute()
+    return parse_candidates(search_resp)
+
+
+def video_durations(youtube, video_ids: list) -> list:
+    """Look up the durations of video_ids with one videos.list call (1 unit), as parse_durations does."""
+    with timed("verify"):
+        videos_resp = youtube.videos().list(
+            part="contentDetails", id=",".join(video_ids), fields=VIDEO_FIELDS
+        ).execute()
+    return parse_durations(videos_resp, video_ids)
+
+
+def match_track(youtube, track: Track) -> tuple:
+    """Search for track and return (videoId, score) of the best candidate.
+
+    When title and artist do not settle it (see needs_verification) the
+    candidates' durations are looked up to break the tie; if that lookup
+    fails they are ranked on title and artist alone.
+    """
+    candidates = search_candidates(youtube, track.query)
+    durations = None
+    if needs_verification(track, score_candidates(track, candidates)):
+        try:
+            durations = video_durations(youtube, [c["video_id"] for c in candidates])
+        except (HttpError, QuotaExhausted) as e:
+            app.logger.warning("Could not verify matches for %r: %s", track.query, e)
+    return best_candidate(track, candidates, durations)
+
+
+def match_and_cache(youtube, track: Track):
+    """match_track, then store the answer in the resolution cache."""
+    video_id, score = match_track(youtube, track)
+    # written before the shared future resolves, so no later lookup misses both
+    record_match(track, video_id, score)
+    return video_id
+
+
+class SingleFlight:
+    """Coalesces concurrent calls for the same key into one call.
+
+    The first caller for a key starts the call; anyone asking for the same
+    key while it is still running gets a future for that call's outcome
+    instead of making another one.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key: str, start) -> tuple:
+        """Return (future, coalesced), calling start() for a new future only if key is not in flight."""
+        with self._lock:
+            leader = self._calls.get(key)
+            if leader is None:
+                leader = self._calls[key] = start()
+                coalesced = False
+            else:
+                coalesced = True
+        if coalesced:
+            # each caller gets its own future, so one caller can wait on the same key twice
+            follower = Future()
+            leader.add_done_callback(functools.partial(_copy_outcome, follower))
+            return follower, True
+        # registered outside the lock: the callback runs inline if the call already finished
+        leader.add_done_callback(functools.partial(self._forget, key))
+        return leader, False
+
+    def _forget(self, key: str, future: Future):
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+
+
+def _copy_outcome(target: Future, source: Future):
+    if source.cancelled():
+        target.cancel()
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+@functools.lru_cache(maxsize=None)
+def get_inflight_searches() -> SingleFlight:
+    """The process-wide table of track searches in flight, keyed by normalized query."""
+    return SingleFlight()
+
+
+_MISS = object()
+
+
+def iter_resolved(youtube, tracks, stats: dict, concurrency: int = SEARCH_CONCURRENCY):
+    """Find a video for each track, yielding (i, track, video_id, error) in playlist order.
+
+    tracks may be any iterable and is read lazily: at most `concurrency`
+    searches are in flight, and at most RESOLVE_WINDOW tracks are held
+    between the one yielded last and the newest one started. Tracks already
+    in the resolution cache, by name or by ISRC (see cached_match), are
+    answered without a search, and a track some other caller is already
+    searching for joins that search instead of starting its own. video_id
+    is None when the search failed or found nothing, and error then says
+    why. The cache hit/miss and coalesced search counts are added to stats.
+    """
+    cache = get_resolution_cache()
+    queued = enumerate(tracks)
+    window = collections.deque()  # (i, track, search future or None, cached videoId)
+    searching = set()  # this call's searches still running
+
+    def fill():
+        while len(window) < RESOLVE_WINDOW and len(searching) < concurrency:
+            i, track = next(queued, (None, None))
+            if track is None:
+                return
+            cached = cached_match(cache, track, _MISS)
+            if cached is not _MISS:
+                stats["cache_hits"] += 1
+                CACHE_REQUESTS.labels("resolution", "hit").inc()
+                window.append((i, track, None, cached))
+                continue
+            stats["cache_misses"] += 1
+            CACHE_REQUESTS.labels("resolution", "miss").inc()
+            future, coalesced = get_inflight_searches().submit(
+                track.key,
+                lambda: _search_executor.submit(contextvars.copy_context().run, match_and_cache, youtube, track),
+            )
+            if coalesced:
+                stats["coalesced"] += 1
+                COALESCED_SEARCHES.inc()
+            searching.add(future)
+            future.add_done_callback(searching.discard)
+            window.append((i, track, future, None))
+
+    fill()
+    while window:
+        i, track, future, video_id = window[0]
+        if future is not None and not future.done():
+            wait(searching | {future}, return_when=FIRST_COMPLETED)
+            fill()
+            continue
+        window.popleft()
+        error = None
+        if future is not None:
+            try:
+                video_id = future.result()
+            except HttpError as e:
+                error = f"Failed to search '{track.query}': {e}"
+            except QuotaExhausted as e:
+                error = f"Skipped '{track.query}': {e}"
+            except Exception as e:
+                # e.g. a connection that kept failing: this track is lost, not the migration
+                error = f"Failed to search '{track.query}': {e}"
+        if video_id is None and error is None:
+            error = f"No YouTube results for '{track.query}'"
+        yield i, track, video_id, error
+        fill()
+
+
+def resolve_tracks(youtube, tracks: list, concurrency: int = SEARCH_CONCURRENCY):
+    """Find a video for every track, as iter_resolved does.
+
+    Returns (video_ids, errors, stats): video_ids[i] is the match for
+    tracks[i] (None when it failed or found nothing), errors lists the
+    failures in playlist order and stats holds the cache hit/miss and
+    coalesced search counts.
+    """
+    stats = {"cache_hits": 0, "cache_misses": 0, "coalesced": 0}
+    video_ids, errors = [], []
+    for _, _, video_id, error in iter_resolved(youtube, tracks, stats, concurrency):
+        video_ids.append(video_id)
+        if error:
+            errors.append(error)
+    return video_ids, errors, stats
+
+
+def list_playlist_video_ids(youtube, playlist_id: str) -> list:
+    """Page through a playlist and return the videoId of every item in it."""
+    video_ids = []
+    page_token = None
+    while True:
+        resp = youtube.playlistItems().list(
+            part="contentDetails",
+            playlistId=playlist_id,
+            maxResults=50,
+            pageToken=page_token,
+            fields="nextPageToken,items/contentDetails/videoId",
+        ).execute()
+        video_ids.extend(item["contentDetails"]["videoId"] for item in resp.get("items", []))
+        page_token = resp.get("nextPageToken")
+        if not page_token:
+            return video_ids
+
+
+def insert_playlist_items(youtube, playlist_id: str, video_ids: list, labels: list = None, on_batch=None):
+    """Append video_ids to a playlist one insert after another, in playlist order.
+
+    The batch endpoint would save round trips, but the API may apply the
+    calls inside one batch in any order, so the inserts are sent in turn as
+    the async server does. Transient failures are retried by
+    call_with_quota, and an item that keeps hitting 409 conflicts is tried
+    up to INSERT_MAX_ROUNDS times before the next one is sent. labels[i]
+    names video_ids[i] in error messages. on_batch(added) is called after
+    every BATCH_SIZE items with the indexes of those it added.
+
+    Returns (migrated_count, errors, stopped_at) with errors in playlist
+    order. stopped_at is None, or the index of the first item not sent
+    because the quota could not cover another insert; nothing from there on
+    was tried.
+    """
+    labels = labels or video_ids
+    errors = []
+    migrated = 0
+    added = []
+    sent = 0
+    stopped_at = None
+
+    def report():
+        nonlocal added
+        if on_batch:
+            on_batch(added)
+        added = []
+
+    for i, video_id in enumerate(video_ids):
+        insert = youtube.playlistItems().insert(
+            part="snippet",
+            body={
+                "snippet": {"playlistId": playlist_id,
+                            "resourceId": {"kind": "youtube#video", "videoId": video_id}}
+            }
+        )
+        for round_ in range(INSERT_MAX_ROUNDS):
+            try:
+                with timed("insert_item"):
+                    insert.execute()
+            except QuotaExhausted:
+                stopped_at = i
+            except HttpError as e:
+                # 409s are YouTube's "concurrent modification" errors for playlist edits
+                if e.resp.status == 409 and round_ + 1 < INSERT_MAX_ROUNDS:
+                    time.sleep(backoff(round_))
+                    continue
+                errors.append(f"Failed to add '{labels[i]}': {e}")
+            except transport_errors() as e:
+                # not resent: the insert may have landed before the connection failed
+                errors.append(f"Failed to add '{labels[i]}': {e}")
+            else:
+                migrated += 1
+                added.append(i)
+            break
+        if stopped_at is not None:
+            break
+        sent += 1
+        if sent % BATCH_SIZE == 0:
+            report()
+    if sent % BATCH_SIZE:
+        report()
+
+    return migrated, errors, stopped_at
+
+
+def split_synced_tracks(tracks: list, present: set, synced: dict):
+    """Split tracks into those still to add and those already in the playlist.
+
+    A track counts as present when the video recorded for it by an earlier
+    run, or else its cached search result, is among the playlist's current
+    videos. Returns (to_add, already) where already holds (key, videoId).
+    """
+    cache = get_resolution_cache()
+    to_add, already = [], []
+    for track in tracks:
+        key = track.key
+        video_id = synced.get(key) or cache.get(key)
+        if video_id in present:
+            already.append((key, video_id))
+        else:
+            to_add.append(track)
+    return to_add, already
+
+
+def prepare_playlist(youtube, playlist_name: str, apple_url: str, playlist_id: str = None):
+    """Return (playlist_id, set of videoIds already in it).
+
+    Without playlist_id a new private playlist is created for playlist_name.
+    """
+    if playlist_id:
+        try:
+            return playlist_id, set(list_playlist_video_ids(youtube, playlist_id))
+        except HttpError as e:
+            raise MigrationError(f"Could not read YouTube playlist {playlist_id}: {e}")
+    try:
+        # create the YouTube playlist
+        body = {
+            "snippet": {
+                "title": f"{playlist_name} (migrated)",
+                "description": f"Migrated from Apple Music: {apple_url}"
+            },
+            "status": {"privacyStatus": "private"}
+        }
+        playlist_resp = youtube.playlists().insert(part="snippet,status", body=body).execute()
+        return playlist_resp["id"], set()
+    except HttpError as e:
+        raise MigrationError(f"Playlist creation error: {e}")
+
+
+def quota_stop_error(not_added: int) -> str:
+    """The one error reported for the tracks left over once the quota stopped the inserts."""
+    return f"YouTube API quota exhausted; {not_added} tracks were not added."
+
+
+def add_resolved_tracks(youtube, playlist_id: str, resolved, on_added=None):
+    """Insert (track, videoId) pairs as they arrive and checkpoint each committed batch.
+
+    resolved may be any iterable, e.g. one fed by iter_resolved: every
+    BATCH_SIZE pairs are inserted as soon as they have arrived, so only one
+    batch is held at a time. on_added(n) is called with the number of items
+    each batch added. Returns (migrated_count, errors).
+
+    When the quota runs out no further inserts are sent: the rest of
+    resolved is still drained, so its failed searches are reported, and the
+    pairs left over are counted in a single quota error.
+    """
+    checkpoint = get_sync_checkpoint()
+    migrated = 0
+    errors = []
+    pairs = iter(resolved)
+    while chunk := list(itertools.islice(pairs, BATCH_SIZE)):
+
+        def on_batch(added, chunk=chunk):
+            checkpoint.record(playlist_id, [(chunk[i][0].key, chunk[i][1]) for i in added])
+            if on_added:
+                on_added(len(added))
+
+        added, chunk_errors, stopped_at = insert_playlist_items(
+            youtube, playlist_id, [vid for _, vid in chunk], labels=[t.query for t, _ in chunk], on_batch=on_batch
+        )
+        migrated += added
+        errors += chunk_errors
+        if stopped_at is not None:
+            errors.append(quota_stop_error(len(chunk) - stopped_at + sum(1 for _ in pairs)))
+            break
+    return migrated, errors
+
+
+def migrate_playlist(youtube, apple_url: str, job=None, playlist_id: str = None):
+    """Copy an Apple Music playlist into YouTube.
+
+    Without playlist_id a new private playlist is created. With one, that
+    existing playlist is synced: only tracks it does not already hold are
+    searched for and added. Returns the context rendered by results.html.
+    When a job is given its stage and progress counters are updated as the
+    migration advances.
+    """
+    if job:
+        job.set_stage("scraping")
+    playlist_name, tracks_or_error = scrape_apple_music_playlist(apple_url)
+
+    if not playlist_name or not isinstance(tracks_or_error, list):
+        raise MigrationError(tracks_or_error or "Failed to scrape playlist.")
+
+    tracks = tracks_or_error
+    if job:
+        job.emit("scraped", name=playlist_name, total=len(tracks))
+        job.set_stage("loading playlist" if playlist_id else "creating playlist")
+    playlist_id, present = prepare_playlist(youtube, playlist_name, apple_url, playlist_id)
+    playlist_url = f"https://www.youtube.com/playlist?list={playlist_id}"
+
+    checkpoint = get_sync_checkpoint()
+    to_add, already = split_synced_tracks(tracks, present, checkpoint.load(playlist_id))
+    checkpoint.record(playlist_id, already)
+
+    if job:
+        job.set_stage("searching and adding", total=len(to_add))
+
+    # tracks stream from the searches straight into insert batches
+    cache_stats = {"cache_hits": 0, "cache_misses": 0, "coalesced": 0}
+    errors = []
+
+    def found():
+        for i, track, video_id, error in iter_resolved(youtube, to_add, cache_stats):
+            if job:
+                job.advance()
+                if error:
+                    job.emit("track", index=i, query=track.query, error=error)
+            if error:
+                errors.append(error)
+            else:
+                yield track, video_id
+
+    def on_added(n):
+        if job:
+            job.emit("batch", added=n, done=job.done, total=job.total)
+
+    migrated, insert_errors = add_resolved_tracks(youtube, playlist_id, found(), on_added)
+
+    return {
+        "playlist_url": playlist_url,
+        "total_songs": len(tracks),
+        "migrated_count": migrated,
+        "already_synced": len(already),
+        "errors": errors + insert_errors,
+        **cache_stats,
+    }
+
+
+# --- Bulk Migration Pipeline ---
+
+_STOP = object()
+
+
+def _start_stage(name: str, fn, inbox: queue.Queue, outbox: queue.Queue, workers: int):
+    """Run fn over work items from inbox on `workers` threads, passing results to outbox.
+
+    Items are dicts; one that fails is reduced to its apple_url and error,
+    and one that already carries an "error" skips fn. When inbox yields
+    _STOP every worker exits and the last one forwards _STOP.
+    """
+    remaining = [workers]
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            item = inbox.get()
+            if item is _STOP:
+                inbox.put(_STOP)
+                break
+            if "error" not in item:
+                try:
+                    item = fn(item)
+                except MigrationError as e:
+                    item = {"apple_url": item["apple_url"], "error": str(e)}
+                except Exception as e:
+                    app.logger.exception("Bulk %s stage failed for %s", name, item["apple_url"])
+                    item = {"apple_url": item["apple_url"], "error": f"Unexpected error: {e}"}
+            outbox.put(item)
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            outbox.put(_STOP)
+
+    for n in range(workers):
+        # each thread runs in its own copy of the job's context so its work is attributed to the job
+        threading.Thread(
+            target=contextvars.copy_context().run, args=(worker,), name=f"bulk-{name}-{n}", daemon=True
+        ).start()
+
+
+def migrate_playlists(youtube, apple_urls: list, job=None):
+    """Migrate many Apple Music playlists into new YouTube playlists.
+
+    Playlists flow through scrape -> resolve -> insert stages joined by
+    bounded queues, each stage with its own worker count, so one playlist
+    is being inserted while the next is searched and a third scraped.
+    Tracks that appear in several playlists are searched once, through the
+    resolution cache and resolve_tracks' coalescing of in-flight searches.
+    Returns the context rendered by results.html.
+    """
+    apple_urls = list(dict.fromkeys(apple_urls))
+
+    def scrape(work):
+        playlist_name, tracks_or_error = scrape_apple_music_playlist(work["apple_url"])
+        if not playlist_name or not isinstance(tracks_or_error, list):
+            raise MigrationError(tracks_or_error or "Failed to scrape playlist.")
+        work.update(name=playlist_name, tracks=tracks_or_error)
+        return work
+
+    def resolve(work):
+        work["video_ids"], work["errors"], work["cache_stats"] = resolve_tracks(youtube, work["tracks"])
+        return work
+
+    def insert(work):
+        playlist_id, _ = prepare_playlist(youtube, work["name"], work["apple_url"])
+        resolved = ((t, vid) for t, vid in zip(work["tracks"], work["video_ids"]) if vid)
+        migrated, insert_errors = add_resolved_tracks(youtube, playlist_id, resolved)
+        return {
+            "apple_url": work["apple_url"],
+            "name": work["name"],
+            "playlist_url": f"https://www.youtube.com/playlist?list={playlist_id}",
+            "total_songs": len(work["tracks"]),
+            "migrated_count": migrated,
+            "errors": work["errors"] + insert_errors,
+            **work["cache_stats"],
+        }
+
+    urls = queue.Queue()
+    scraped = queue.Queue(BULK_QUEUE_SIZE)
+    resolved = queue.Queue(BULK_QUEUE_SIZE)
+    finished = queue.Queue()
+    _start_stage("scrape", scrape, urls, scraped, BULK_SCRAPE_WORKERS)
+    _start_stage("resolve", resolve, scraped, resolved, BULK_RESOLVE_WORKERS)
+    _start_stage("insert", insert, resolved, finished, BULK_INSERT_WORKERS)
+    for url in apple_urls:
+        urls.put({"apple_url": url})
+    urls.put(_STOP)
+
+    if job:
+        job.set_stage("migrating playlists", total=len(apple_urls))
+    results = {}
+    while True:
+        item = finished.get()
+        if item is _STOP:
+            break
+        results[item["apple_url"]] = item
+        if job:
+            job.advance()
+            job.emit("playlist", result=item)
+
+    playlists = [results[url] for url in apple_urls]
+    done = [p for p in playlists if "error" not in p]
+    return {
+        "playlists": playlists,
+        "total_songs": sum(p["total_songs"] for p in done),
+        "migrated_count": sum(p["migrated_count"] for p in done),
+        "errors": [],
+    }
+
+
+# --- Background Jobs ---
+
+class Job:
+    """A playlist migration queued on, or running in, the worker pool."""
+
+    def __init__(self, apple_url: str = None, playlist_id: str = None, apple_urls: list = None):
+        self.id = uuid.uuid4().hex
+        self.apple_url = apple_url
+        self.playlist_id = playlist_id
+        self.apple_urls = apple_urls  # set for a bulk migration
+        self.status = "queued"  # queued -> running -> done | failed
+        self.stage = None
+        self.total = 0
+        self.done = 0
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.timings = {}  # stage -> seconds, summed across threads
+        self.quota_units = 0
+        # progress events, replayed to every /jobs/<id>/events stream; tracks that
+        # succeed only advance `done`, so a job keeps its errors rather than an event per track
+        self.events = []
+        self._listeners = []  # called after every event, e.g. to wake an async stream
+        self._cond = threading.Condition()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed")
+
+    def emit(self, event: str, **data):
+        with self._cond:
+            self.events.append({"id": len(self.events), "event": event, "data": data})
+            self._cond.notify_all()
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener()
+
+    def advance(self, n: int = 1):
+        """Count n more items done and wake the progress streams without recording an event."""
+        with self._cond:
+            self.done += n
+            self._cond.notify_all()
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener()
+
+    def subscribe(self, listener):
+        """Call listener() after each new event, from whichever thread emits it."""
+        with self._cond:
+            self._listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        with self._cond:
+            self._listeners.remove(listener)
+
+    def add_timing(self, stage: str, seconds: float):
+        with self._cond:
+            self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+
+    def add_quota(self, units: int):
+        with self._cond:
+            self.quota_units += units
+
+    def set_stage(self, stage: str, total: int = None):
+        self.stage = stage
+        if total is not None:
+            self.total = total
+            self.done = 0
+        self.emit("stage", stage=stage, total=self.total)
+
+    def finish(self, result: dict = None, error: str = None):
+        """Record the outcome and emit the final "done" or "failed" event."""
+        with self._cond:
+            self.result = result
+            self.error = error
+            self.status = "failed" if error else "done"
+            self.finished_at = time.time()
+            if error:
+                self.emit("failed", error=error)
+            else:
+                self.emit("done", result=result)
+
+    def wait_for_events(self, index: int, timeout: float, done: int = None) -> list:
+        """Return the events from index on, waiting up to timeout for one if there are none yet.
+
+        With done given the wait also ends as soon as the job's done count
+        differs from it.
+        """
+        with self._cond:
+            if len(self.events) <= index and not self.finished and done in (None, self.done):
+                self._cond.wait(timeout)
+            return self.events[index:]
+
+    def progress_event(self) -> str:
+        """The unrecorded Server-Sent Event carrying the done count."""
+        return f"event: progress\ndata: {json.dumps({'done': self.done, 'total': self.total})}\n\n"
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "stage": self.stage,
+            "total": self.total,
+            "done": self.done,
+            "quota_units": self.quota_units,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+def replay_start(last_event_id) -> int:
+    """The index of the first event to send a stream that resumes after last_event_id.
+
+    Event ids are indexes into Job.events; a missing or malformed
+    Last-Event-ID header replays them all.
+    """
+    try:
+        return max(int(last_event_id) + 1, 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=MIGRATION_WORKERS, thread_name_prefix="migration")
+
+
+def _prune_jobs():
+    """Forget finished jobs older than JOB_RETENTION_SECONDS. Caller holds _jobs_lock."""
+    cutoff = time.time() - JOB_RETENTION_SECONDS
+    for job_id in [j.id for j in _jobs.values() if j.finished and j.finished_at < cutoff]:
+        del _jobs[job_id]
+
+
+def _log_job(job: Job):
+    """Write one structured log line summarising a finished job."""
+    result = job.result or {}
+    app.logger.info(json.dumps({
+        "event": "job_finished",
+        "job_id": job.id,
+        "status": job.status,
+        "seconds": round(job.finished_at - job.created_at, 3),
+        "playlists": len(job.apple_urls) if job.apple_urls else 1,
+        "total_songs": result.get("total_songs"),
+        "migrated_count": result.get("migrated_count"),
+        "quota_units": job.quota_units,
+        "cache_hits": result.get("cache_hits"),
+        "cache_misses": result.get("cache_misses"),
+        "coalesced_searches": result.get("coalesced"),
+        "stage_seconds": {stage: round(s, 3) for stage, s in job.timings.items()},
+        "error": job.error,
+    }))
+
+
+@contextlib.contextmanager
+def running_job(job: Job):
+    """Run the block as job's work: attribute metrics to it and record a failure as its outcome."""
+    job.status = "running"
+    token = _current_job.set(job)
+    JOBS_IN_FLIGHT.inc()
+    try:
+        yield
+    except MigrationError as e:
+        job.finish(error=str(e))
+    except Exception as e:
+        app.logger.exception("Migration job %s failed", job.id)
+        job.finish(error=f"Unexpected error: {e}")
+    finally:
+        _current_job.reset(token)
+        JOBS_IN_FLIGHT.dec()
+        JOBS_FINISHED.labels(job.status).inc()
+        JOB_QUOTA_UNITS.observe(job.quota_units)
+        _log_job(job)
+
+
+def _run_job(job: Job, youtube):
+    with running_job(job):
+        if job.apple_urls:
+            job.finish(result=migrate_playlists(youtube, job.apple_urls, job))
+        else:
+            job.finish(result=migrate_playlist(youtube, job.apple_url, job, playlist_id=job.playlist_id))
+
+
+def register_job(job: Job) -> Job:
+    """Make job visible to the /jobs routes."""
+    with _jobs_lock:
+        _prune_jobs()
+        _jobs[job.id] = job
+    return job
+
+
+def submit_job(youtube, apple_url: str = None, playlist_id: str = None, apple_urls: list = None) -> Job:
+    """Queue a migration on the worker pool and return its job immediately."""
+    job = register_job(Job(apple_url, playlist_id, apple_urls))
+    _executor.submit(_run_job, job, youtube)
+    return job
+
+
+# --- Admission Control ---
+
+class AdmissionControl:
+    """Limits the migrations in flight, overall and per user.
+
+    Up to max_running migrations run at once and up to max_queued more wait
+    for a slot; beyond that new ones are turned away until some finish, so
+    a spike is answered with a quick "try later" rather than a queue that
+    every migration has to wait through. A user may have max_per_user
+    migrations in flight, and never two of the same playlist.
+    """
+
+    def __init__(self, max_running: int, max_queued: int, max_per_user: int):
+        self.capacity = max_running + max_queued
+        self.max_per_user = max_per_user
+        self._in_flight = {}  # job id -> (job, user id, canonical playlist URLs)
+        self._lock = threading.Lock()
+
+    def check(self, user_id, apple_urls: list):
+        """Raise MigrationRejected if migrating apple_urls for user_id would be turned away now."""
+        with self._lock:
+            self._check(user_id, {canonical_playlist_url(url) for url in apple_urls})
+
+    def admit(self, user_id, apple_urls: list, start) -> "Job":
+        """Check the migration and, if it is admitted, call start() for its Job and track it."""
+        keys = {canonical_playlist_url(url) for url in apple_urls}
+        with self._lock:
+            self._check(user_id, keys)
+            job = start()
+            self._in_flight[job.id] = (job, user_id, keys)
+        return job
+
+    def _check(self, user_id, keys: set):
+        """Caller holds _lock."""
+        for job_id in [j.id for j, _, _ in self._in_flight.values() if j.finished]:
+            del self._in_flight[job_id]
+        if user_id is not None:
+            mine = [(job, job_keys) for job, owner, job_keys in self._in_flight.values() if owner == user_id]
+            for job, job_keys in mine:
+                if job_keys & keys:
+                    raise MigrationRejected("This playlist is already being migrated.", job=job)
+            if len(mine) >= self.max_per_user:
+                raise MigrationRejected(
+                    f"You already have {len(mine)} migrations in progress; "
+                    "please wait for one to finish before starting another.",
+                    retry_after=ADMISSION_RETRY_AFTER,
+                )
+        if len(self._in_flight) >= self.capacity:
+            raise MigrationRejected(
+                "The migrator is busy with other migrations right now; please try again in a minute.",
+                retry_after=ADMISSION_RETRY_AFTER,
+            )
+
+
+@functools.lru_cache(maxsize=None)
+def get_admission_control() -> AdmissionControl:
+    return AdmissionControl(MIGRATION_WORKERS, MAX_QUEUED_MIGRATIONS, MAX_USER_MIGRATIONS)
+
+
+def get_job(job_id: str):
+    with _jobs_lock:
+        return _jobs.get(job_id)
+
+
+# bulk URL lists wait here during the OAuth round-trip; they can outgrow a session cookie
+_pending_bulk = {}
+
+
+def stash_bulk_urls(apple_urls: list) -> str:
+    bulk_id = uuid.uuid4().hex
+    with _jobs_lock:
+        _pending_bulk[bulk_id] = (time.time(), apple_urls)
+        cutoff = time.time() - JOB_RETENTION_SECONDS
+        for stale in [k for k, (stashed_at, _) in _pending_bulk.items() if stashed_at < cutoff]:
+            del _pending_bulk[stale]
+    return bulk_id
+
+
+def peek_bulk_urls(bulk_id: str):
+    with _jobs_lock:
+        return _pending_bulk.get(bulk_id, (None, None))[1]
+
+
+def forget_pending_migration(user_session):
+    """Drop the migration stashed in user_session for /process, once it has been admitted.
+
+    Until then it stays, so a request turned away with 429 can simply be
+    sent again.
+    """
+    bulk_id = user_session.pop("bulk_id", None)
+    if bulk_id:
+        with _jobs_lock:
+            _pending_bulk.pop(bulk_id, None)
+    user_session.pop("apple_music_url", None)
+    user_session.pop("youtube_playlist_id", None)
+
+
+def stage_migration(form, user_session, admission: AdmissionControl):
+    """Check the /migrate form and keep the migration it asks for in user_session until /process.
+
+    Returns an error message for a 400 response, or None. Raises
+    MigrationRejected when admission would turn the migration away anyway,
+    so that happens before the OAuth round-trip rather than after it.
+    """
+    apple_url = form.get("apple_music_url")
+    # bulk form: one Apple Music URL per line
+    apple_urls = form.get("apple_music_urls", "").split()
+    if not apple_url and not apple_urls:
+        return "Please provide an Apple Music playlist URL."
+    if len(apple_urls) > BULK_MAX_PLAYLISTS:
+        return f"Please submit at most {BULK_MAX_PLAYLISTS} playlists at a time."
+    admission.check(user_session.get("user_id"), apple_urls or [apple_url])
+
+    if apple_urls:
+        user_session["bulk_id"] = stash_bulk_urls(apple_urls)
     else:
-        print(f"Response for request {request_id}: {response}")
+        user_session["apple_music_url"] = apple_url
+        # optional: sync into an existing YouTube playlist instead of creating one
+        youtube_playlist = form.get("youtube_playlist", "").strip()
+        user_session["youtube_playlist_id"] = parse_playlist_id(youtube_playlist) if youtube_playlist else None
+    return None
+
+
+def has_pending_migration(user_session) -> bool:
+    return "apple_music_url" in user_session or "bulk_id" in user_session
+
+
+def start_pending_migration(user_session, admission: AdmissionControl, submit):
+    """Admit the migration stage_migration() kept in user_session and start it with submit.
+
+    submit takes submit_job's arguments after youtube. Returns the job, or
+    None if the stashed bulk list has expired. Raises MigrationRejected; a
+    duplicate's pending migration is forgotten first, since the one in
+    flight stands in for it.
+    """
+    try:
+        if "bulk_id" in user_session:
+            apple_urls = peek_bulk_urls(user_session["bulk_id"])
+            if not apple_urls:
+                forget_pending_migration(user_session)
+                return None
+            job = admission.admit(user_session["user_id"], apple_urls, lambda: submit(apple_urls=apple_urls))
+        else:
+            apple_url = user_session.get("apple_music_url")
+            playlist_id = user_session.get("youtube_playlist_id")
+            job = admission.admit(
+                user_session["user_id"], [apple_url], lambda: submit(apple_url, playlist_id=playlist_id)
+            )
+    except MigrationRejected as e:
+        if e.job is not None:
+            forget_pending_migration(user_session)
+        raise
+    forget_pending_migration(user_session)
+    user_session["job_id"] = job.id
+    return job
+
+
+def rejected_response(e: MigrationRejected, wants_json: bool, build_url):
+    """Send a duplicate to the migration already in flight, and answer anything else with 429.
+
+    build_url is the serving framework's url_for; the response is a tuple
+    that Flask and Quart views can both return.
+    """
+    if e.job is not None:
+        if wants_json:
+            return {"error": str(e), "job_id": e.job.id, "status_url": build_url("job_status", job_id=e.job.id)}, 409
+        return "", 302, {"Location": build_url("job_page", job_id=e.job.id)}
+    headers = {"Retry-After": str(e.retry_after)}
+    if wants_json:
+        return {"error": str(e)}, 429, headers
+    return str(e), 429, headers
+
+
+# --- Startup ---
+
+def warm_up():
+    """Load what the first sign-in and migration need, off the request path."""
+    start = time.perf_counter()
+    import google_auth_oauthlib.flow
+    import google.auth.transport.requests
+
+    _youtube_request_class()
+    _discovery_document()
+    get_http_session()
+    _thread_http()
+    STARTUP_SECONDS.labels("warm_up").set(time.perf_counter() - start)
+
+
+def start_warm_up():
+    """Run warm_up() on a background thread; call it in each serving process, after any fork."""
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
 
 
 # --- Flask Routes ---
@@ -97,14 +1930,13 @@ def index():
 
 @app.route("/migrate", methods=["POST"])
 def migrate():
-    apple_url = request.form.get("apple_music_url")
-    if not apple_url:
-        return "Please provide an Apple Music playlist URL.", 400
-
-    session["apple_music_url"] = apple_url
-    client_config = get_client_config()
-    flow = Flow.from_client_config(client_config, SCOPES)
-    flow.redirect_uri = url_for("oauth2callback", _external=True)
+    try:
+        error = stage_migration(request.form, session, get_admission_control())
+    except MigrationRejected as e:
+        return rejected_response(e, request.accept_mimetypes.best == "application/json", url_for)
+    if error:
+        return error, 400
+    flow = oauth_flow(url_for("oauth2callback", _external=True))
 
     auth_url, state = flow.authorization_url(
         access_type="offline", include_granted_scopes="true"
@@ -119,114 +1951,95 @@ def oauth2callback():
     if not state:
         return redirect(url_for("index"))
 
-    client_config = get_client_config()
-    flow = Flow.from_client_config(client_config, SCOPES, state=state)
-    flow.redirect_uri = url_for("oauth2callback", _external=True)
+    flow = oauth_flow(url_for("oauth2callback", _external=True), state=state)
 
     flow.fetch_token(authorization_response=request.url)
-    creds = flow.credentials
-    session["credentials"] = credentials_to_dict(creds)
+    # credentials stay server-side; the cookie only names the user
+    user_id = session.get("user_id") or uuid.uuid4().hex
+    get_credential_store().put(user_id, flow.credentials)
+    session["user_id"] = user_id
     return redirect(url_for("process_playlist"))
 
 
 @app.route("/process")
 def process_playlist():
-    if "credentials" not in session or "apple_music_url" not in session:
+    youtube = get_credential_store().client(session["user_id"]) if "user_id" in session else None
+    if youtube is None or not has_pending_migration(session):
+        # a refresh after the job was queued should not start it again
+        if session.get("job_id") and get_job(session["job_id"]):
+            return redirect(url_for("job_page", job_id=session["job_id"]))
         return redirect(url_for("index"))
 
-    # reconstruct credentials
-    creds = Credentials(**session["credentials"])
-    # refresh if expired
-    if creds.expired and creds.refresh_token:
-        creds.refresh(requests.Request())
-        session["credentials"] = credentials_to_dict(creds)
+    wants_json = request.accept_mimetypes.best == "application/json"
+    try:
+        job = start_pending_migration(session, get_admission_control(), functools.partial(submit_job, youtube))
+    except MigrationRejected as e:
+        return rejected_response(e, wants_json, url_for)
+    if job is None:
+        return redirect(url_for("index"))
 
-    youtube = build(API_SERVICE_NAME, API_VERSION, credentials=creds)
-    apple_url = session.pop("apple_music_url", None)
-    playlist_name, tracks_or_error = scrape_apple_music_playlist(apple_url)
+    if wants_json:
+        return {"job_id": job.id, "status_url": url_for("job_status", job_id=job.id)}, 202
+    return redirect(url_for("job_page", job_id=job.id))
 
-    if not playlist_name or not isinstance(tracks_or_error, list):
-        return render_template(
-            "results.html", error=tracks_or_error or "Failed to scrape playlist."
-        )
 
-    tracks = tracks_or_error
-    try:
-        # create the YouTube playlist
-        body = {
-            "snippet": {
-                "title": f"{playlist_name} (migrated)",
-                "description": f"Migrated from Apple Music: {apple_url}"
-            },
-            "status": {"privacyStatus": "private"}
-        }
-        playlist_resp = youtube.playlists().insert(part="snippet,status", body=body).execute()
-        playlist_id = playlist_resp["id"]
-        playlist_url = f"https://www.youtube.com/playlist?list={playlist_id}"
-    except HttpError as e:
-        return render_template("results.html", error=f"Playlist creation error: {e}")
+@app.route("/jobs/<job_id>")
+def job_page(job_id):
+    job = get_job(job_id)
+    if not job:
+        abort(404)
+    if job.status == "failed":
+        return render_template("results.html", error=job.error)
+    return render_template("results.html", job=job.to_dict(), **(job.result or {}))
 
-    """migrated, errors = 0, []
-    for q in tracks:
-        try:
-            search_resp = youtube.search().list(
-                part="snippet", q=q, type="video", maxResults=1
-            ).execute()
-
-            items = search_resp.get("items", [])
-            if items:
-                vid = items[0]["id"]["videoId"]
-                youtube.playlistItems().insert(
-                    part="snippet",
-                    body={
-                        "snippet": {"playlistId": playlist_id,
-                                    "resourceId": {"kind": "youtube#video", "videoId": vid}}
-                    }
-                ).execute()
-                migrated += 1
-        except HttpError as e:
-            errors.append(f"Failed to add '{q}': {e}")"""
-    
-    tracks_to_add = []
-    for q in tracks:
-        search_resp = youtube.search().list(
-            part="snippet", q=q, type="video", maxResults=1
-        ).execute()
 
-        items = search_resp.get("items", [])
-        if items:
-            tracks_to_add.append(items[0]["id"]["videoId"])
-
-    batch = youtube.new_batch_http_request()
-    for track in tracks_to_add:
-        index += 1
-        batch.add(
-            youtube.playlistItems().insert(
-                    part="snippet",
-                    body={
-                        "snippet": {"playlistId": playlist_id,
-                                    "resourceId": {"kind": "youtube#video", "videoId": track}}
-                    }
-                ),
-            callback=callback,
-            request_id="track"+str(index)
-        )
+@app.route("/jobs/<job_id>/events")
+def job_events(job_id):
+    """Stream the job's progress as Server-Sent Events, resuming after Last-Event-ID."""
+    job = get_job(job_id)
+    if not job:
+        return jsonify({"error": "Unknown job id."}), 404
+    start = replay_start(request.headers.get("Last-Event-ID"))
+
+    def stream():
+        index, done = start, None
+        while True:
+            events = job.wait_for_events(index, timeout=15, done=done)
+            for event in events:
+                yield f"id: {event['id']}\nevent: {event['event']}\ndata: {json.dumps(event['data'])}\n\n"
+            index += len(events)
+            if job.done != done:
+                done = job.done
+                yield job.progress_event()
+            elif not events:
+                if job.finished:
+                    return
+                yield ": keep-alive\n\n"
 
-    batch.execute()
+    return Response(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
+@app.route("/jobs/<job_id>/status")
+def job_status(job_id):
+    job = get_job(job_id)
+    if not job:
+        return jsonify({"error": "Unknown job id."}), 404
+    return jsonify(job.to_dict())
 
 
+@app.route("/metrics")
+def metrics():
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
 
-    return render_template(
-        "results.html",
-        playlist_url=playlist_url,
-        total_songs=len(tracks),
-        migrated_count=0, #migrated_count=migrated,
-        errors=0 #errors=errors,
-    )
+
+STARTUP_SECONDS.labels("import").set(time.perf_counter() - _IMPORT_STARTED)
 
 
 if __name__ == "__main__":
+    start_warm_up()
     port = int(os.environ.get("PORT", 8080))
     app.run(host="0.0.0.0", port=port, debug=True)
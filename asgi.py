@@ -0,0 +1,618 @@
+"""Async (ASGI) serving mode for the migrator.
+
+    hypercorn --bind 0.0.0.0:8080 asgi:app
+
+Serves the routes and templates of app.py from a Quart app whose views are
+coroutines. Migrations run as tasks on the event loop and do all of their
+network I/O with httpx, so a single worker carries many I/O-bound
+migrations at once instead of tying up a thread for each one. Caches, quota
+scheduling, credentials, jobs and metrics are app.py's own; only the
+transport changes. The WSGI app in app.py stays the default (see the
+Dockerfile's SERVER_MODE).
+"""
+import asyncio
+import collections
+import functools
+import json
+import os
+import uuid
+from concurrent.futures import Future
+
+import httpx
+from googleapiclient.errors import HttpError
+from quart import Quart, Response, abort, jsonify, redirect, render_template, request, session, url_for
+
+import app as migrator
+from app import MigrationError, MigrationRejected, QuotaExhausted, timed
+
+# --- Async Configuration ---
+API_BASE_URL = (migrator.YOUTUBE_API_ROOT or "https://youtube.googleapis.com/").rstrip("/") + "/youtube/v3/"
+# connections the event loop may hold open, to Apple Music and the YouTube API together
+ASYNC_MAX_CONNECTIONS = int(os.environ.get("ASYNC_MAX_CONNECTIONS", 256))
+# playlists of one bulk migration that are migrated at the same time
+ASYNC_BULK_CONCURRENCY = int(os.environ.get("ASYNC_BULK_CONCURRENCY", 8))
+# migrations running at once; the rest wait, up to MAX_QUEUED_MIGRATIONS of them
+ASYNC_MAX_RUNNING_MIGRATIONS = int(os.environ.get("ASYNC_MAX_RUNNING_MIGRATIONS", 200))
+
+app = Quart(__name__)
+app.secret_key = migrator.app.secret_key
+
+_http = None  # the loop's httpx.AsyncClient, opened before serving
+_tasks = set()  # strong references to running job and search tasks
+_running = asyncio.Semaphore(ASYNC_MAX_RUNNING_MIGRATIONS)
+
+
+@app.before_serving
+async def open_http_client():
+    global _http
+    migrator.start_warm_up()
+    _http = httpx.AsyncClient(
+        timeout=migrator.HTTP_TIMEOUT,
+        limits=httpx.Limits(
+            max_connections=ASYNC_MAX_CONNECTIONS, max_keepalive_connections=migrator.HTTP_POOL_SIZE
+        ),
+    )
+
+
+@app.after_serving
+async def close_http_client():
+    await _http.aclose()
+
+
+def _spawn(coro):
+    task = asyncio.ensure_future(coro)
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
+
+
+# --- Scraping ---
+
+async def scrape_apple_music_playlist(url: str):
+    """Async scrape_apple_music_playlist: same revalidation, parsing and result."""
+    key, cached, headers = migrator.scrape_revalidation(url)
+    try:
+        with timed("scrape_fetch"):
+            async with _http.stream(
+                "GET", url, headers={"User-Agent": migrator.USER_AGENT, **headers}, follow_redirects=True
+            ) as resp:
+                if resp.status_code == 304 and cached:
+                    return migrator.scrape_not_modified(key, cached)
+                migrator.CACHE_REQUESTS.labels("scrape", "miss").inc()
+                resp.raise_for_status()
+                validators = resp.headers.get("ETag"), resp.headers.get("Last-Modified")
+                scanner = migrator.EmbeddedJsonScanner()
+                async for chunk in resp.aiter_bytes(64 * 1024):
+                    body = scanner.feed(chunk)
+                    if body is not None:
+                        break
+                else:
+                    body = scanner.fallback
+        return migrator.finish_scrape(key, body, validators)
+
+    except httpx.HTTPError as e:
+        return None, f"Network error: {e}"
+    except (ValueError, KeyError, IndexError, TypeError) as e:
+        return None, f"Parsing error: {e}"
+
+
+# --- YouTube Client ---
+
+class AsyncYouTube:
+    """The YouTube Data API calls a migration makes, sent with httpx."""
+
+    def __init__(self, credentials):
+        self.credentials = credentials
+
+    async def call(self, method_id: str, http_method: str, resource: str, params: dict, body: dict = None):
+        """Make one API call under the quota scheduler, retrying transient failures like call_with_quota."""
+        for attempt in range(migrator.API_MAX_RETRIES + 1):
+            await asyncio.sleep(migrator.reserve_quota(method_id))
+            try:
+                resp = await _http.request(
+                    http_method, API_BASE_URL + resource, params=params, json=body, headers=await self._auth_headers()
+                )
+            except httpx.TransportError:
+                # as call_with_quota: an insert that lost its connection may have landed, so only reads are resent
+                if attempt == migrator.API_MAX_RETRIES or method_id not in migrator.READ_ONLY_METHODS:
+                    raise
+                await asyncio.sleep(migrator.backoff(attempt))
+                continue
+            if resp.is_success:
+                return resp.json()
+            import httplib2
+
+            # the same error the discovery client raises, so error handling is shared
+            error = HttpError(httplib2.Response({"status": resp.status_code}), resp.content, uri=str(resp.url))
+            delay = migrator.retry_delay(error, attempt)
+            if delay is None:
+                raise error
+            await asyncio.sleep(delay)
+
+    async def _auth_headers(self) -> dict:
+        creds = self.credentials
+        if not creds.valid:
+            from google.auth.transport.requests import Request as GoogleAuthRequest
+
+            # the credential store's refresher normally gets here first
+            await asyncio.to_thread(creds.refresh, GoogleAuthRequest(migrator.get_http_session()))
+        return {"Authorization": f"Bearer {creds.token}"}
+
+    async def search_candidates(self, query: str) -> list:
+        with timed("search"):
+            resp = await self.call(
+                "youtube.search.list", "GET", "search",
+                {
+                    "part": "snippet",
+                    "q": query,
+                    "type": "video",
+                    "maxResults": migrator.SEARCH_CANDIDATES,
+                    "fields": migrator.SEARCH_FIELDS,
+                },
+            )
+        return migrator.parse_candidates(resp)
+
+    async def video_durations(self, video_ids: list) -> list:
+        with timed("verify"):
+            resp = await self.call(
+                "youtube.videos.list", "GET", "videos",
+                {
+                    "part": "contentDetails",
+                    "id": ",".join(video_ids),
+                    "fields": migrator.VIDEO_FIELDS,
+                },
+            )
+        return migrator.parse_durations(resp, video_ids)
+
+    async def match_track(self, track: migrator.Track) -> tuple:
+        """Async match_track: search, verify durations when needed, return (videoId, score)."""
+        candidates = await self.search_candidates(track.query)
+        durations = None
+        if migrator.needs_verification(track, migrator.score_candidates(track, candidates)):
+            try:
+                durations = await self.video_durations([c["video_id"] for c in candidates])
+            except (HttpError, QuotaExhausted) as e:
+                app.logger.warning("Could not verify matches for %r: %s", track.query, e)
+        return migrator.best_candidate(track, candidates, durations)
+
+    async def list_playlist_video_ids(self, playlist_id: str) -> list:
+        video_ids = []
+        params = {
+            "part": "contentDetails",
+            "playlistId": playlist_id,
+            "maxResults": 50,
+            "fields": "nextPageToken,items/contentDetails/videoId",
+        }
+        while True:
+            resp = await self.call("youtube.playlistItems.list", "GET", "playlistItems", params)
+            video_ids.extend(item["contentDetails"]["videoId"] for item in resp.get("items", []))
+            if not resp.get("nextPageToken"):
+                return video_ids
+            params["pageToken"] = resp["nextPageToken"]
+
+    async def create_playlist(self, playlist_name: str, apple_url: str) -> str:
+        body = {
+            "snippet": {
+                "title": f"{playlist_name} (migrated)",
+                "description": f"Migrated from Apple Music: {apple_url}"
+            },
+            "status": {"privacyStatus": "private"}
+        }
+        resp = await self.call("youtube.playlists.insert", "POST", "playlists", {"part": "snippet,status"}, body)
+        return resp["id"]
+
+    async def insert_playlist_item(self, playlist_id: str, video_id: str):
+        body = {
+            "snippet": {"playlistId": playlist_id, "resourceId": {"kind": "youtube#video", "videoId": video_id}}
+        }
+        with timed("insert_item"):
+            await self.call("youtube.playlistItems.insert", "POST", "playlistItems", {"part": "snippet"}, body)
+
+
+# --- Migration ---
+
+async def _search_into(youtube: AsyncYouTube, track: migrator.Track, future: Future):
+    """match_and_cache for the event loop, delivering the outcome to future."""
+    try:
+        video_id, score = await youtube.match_track(track)
+        migrator.record_match(track, video_id, score)
+    except Exception as e:
+        future.set_exception(e)
+    else:
+        future.set_result(video_id)
+
+
+def _start_search(youtube: AsyncYouTube, track: migrator.Track) -> Future:
+    future = Future()
+    _spawn(_search_into(youtube, track, future))
+    return future
+
+
+_MISS = object()
+
+
+async def iter_resolved(youtube: AsyncYouTube, tracks, stats: dict):
+    """Async iter_resolved: yields (i, track, video_id, error) in playlist order.
+
+    Up to RESOLVE_WINDOW tracks are resolved ahead of the one yielded last,
+    with at most SEARCH_CONCURRENCY searches in flight, through the same
+    cache and coalescing of in-flight searches.
+    """
+    cache = migrator.get_resolution_cache()
+    searches = asyncio.Semaphore(migrator.SEARCH_CONCURRENCY)
+    queued = enumerate(tracks)
+    window = collections.deque()  # resolve() tasks in playlist order
+
+    async def resolve(i: int, track: migrator.Track):
+        video_id = error = None
+        cached = migrator.cached_match(cache, track, _MISS)
+        if cached is not _MISS:
+            stats["cache_hits"] += 1
+            migrator.CACHE_REQUESTS.labels("resolution", "hit").inc()
+            video_id = cached
+        else:
+            stats["cache_misses"] += 1
+            migrator.CACHE_REQUESTS.labels("resolution", "miss").inc()
+            async with searches:
+                future, coalesced = migrator.get_inflight_searches().submit(
+                    track.key, functools.partial(_start_search, youtube, track)
+                )
+                if coalesced:
+                    stats["coalesced"] += 1
+                    migrator.COALESCED_SEARCHES.inc()
+                try:
+                    # shielded: giving up on this migration must not cancel a search others share
+                    video_id = await asyncio.shield(asyncio.wrap_future(future))
+                except HttpError as e:
+                    error = f"Failed to search '{track.query}': {e}"
+                except QuotaExhausted as e:
+                    error = f"Skipped '{track.query}': {e}"
+                except Exception as e:
+                    # e.g. an httpx.HTTPError that outlasted the retries: this track is lost, not the migration
+                    error = f"Failed to search '{track.query}': {e}"
+        if video_id is None and error is None:
+            error = f"No YouTube results for '{track.query}'"
+        return i, track, video_id, error
+
+    def fill():
+        while len(window) < migrator.RESOLVE_WINDOW:
+            i, track = next(queued, (None, None))
+            if track is None:
+                return
+            window.append(asyncio.ensure_future(resolve(i, track)))
+
+    try:
+        fill()
+        while window:
+            result = await window.popleft()
+            fill()
+            yield result
+    finally:
+        for task in window:
+            task.cancel()
+
+
+async def prepare_playlist(youtube: AsyncYouTube, playlist_name: str, apple_url: str, playlist_id: str = None):
+    """Async prepare_playlist: returns (playlist_id, set of videoIds already in it)."""
+    if playlist_id:
+        try:
+            return playlist_id, set(await youtube.list_playlist_video_ids(playlist_id))
+        except HttpError as e:
+            raise MigrationError(f"Could not read YouTube playlist {playlist_id}: {e}")
+    try:
+        return await youtube.create_playlist(playlist_name, apple_url), set()
+    except HttpError as e:
+        raise MigrationError(f"Playlist creation error: {e}")
+
+
+async def add_resolved_tracks(youtube: AsyncYouTube, playlist_id: str, resolved, on_added=None):
+    """Async add_resolved_tracks over an async iterable of (track, videoId) pairs.
+
+    Items are inserted one after another rather than through the batch
+    endpoint, which keeps the playlist in order and costs the same quota;
+    the concurrency comes from running many migrations at once. Progress
+    is checkpointed and reported every BATCH_SIZE items, and an item that
+    keeps hitting 409 conflicts is tried up to INSERT_MAX_ROUNDS times.
+    Once the quota runs out the rest of resolved is drained without
+    inserting and counted in a single quota error. Returns
+    (migrated_count, errors).
+    """
+    checkpoint = migrator.get_sync_checkpoint()
+    migrated = 0
+    errors = []
+    added = []
+
+    def commit():
+        checkpoint.record(playlist_id, added)
+        if on_added:
+            on_added(len(added))
+
+    seen = 0
+    not_added = 0
+    async for track, video_id in resolved:
+        if not_added:
+            not_added += 1
+            continue
+        for round_ in range(migrator.INSERT_MAX_ROUNDS):
+            try:
+                await youtube.insert_playlist_item(playlist_id, video_id)
+            except QuotaExhausted:
+                not_added = 1
+            except HttpError as e:
+                # 409s are YouTube's "concurrent modification" errors for playlist edits
+                if e.resp.status == 409 and round_ + 1 < migrator.INSERT_MAX_ROUNDS:
+                    await asyncio.sleep(migrator.backoff(round_))
+                    continue
+                errors.append(f"Failed to add '{track.query}': {e}")
+            except httpx.HTTPError as e:
+                # not resent: the insert may have landed before the connection failed
+                errors.append(f"Failed to add '{track.query}': {e}")
+            else:
+                added.append((track.key, video_id))
+            break
+        seen += 1
+        if seen % migrator.BATCH_SIZE == 0:
+            migrated += len(added)
+            commit()
+            added = []
+    if seen % migrator.BATCH_SIZE:
+        migrated += len(added)
+        commit()
+    if not_added:
+        errors.append(migrator.quota_stop_error(not_added))
+    return migrated, errors
+
+
+async def _migrate(youtube: AsyncYouTube, apple_url: str, job=None, playlist_id: str = None):
+    """Async migrate_playlist, returning (playlist name, results.html context)."""
+    if job:
+        job.set_stage("scraping")
+    playlist_name, tracks_or_error = await scrape_apple_music_playlist(apple_url)
+
+    if not playlist_name or not isinstance(tracks_or_error, list):
+        raise MigrationError(tracks_or_error or "Failed to scrape playlist.")
+
+    tracks = tracks_or_error
+    if job:
+        job.emit("scraped", name=playlist_name, total=len(tracks))
+        job.set_stage("loading playlist" if playlist_id else "creating playlist")
+    playlist_id, present = await prepare_playlist(youtube, playlist_name, apple_url, playlist_id)
+
+    checkpoint = migrator.get_sync_checkpoint()
+    to_add, already = migrator.split_synced_tracks(tracks, present, checkpoint.load(playlist_id))
+    checkpoint.record(playlist_id, already)
+
+    if job:
+        job.set_stage("searching and adding", total=len(to_add))
+
+    # tracks stream from the searches straight into inserts
+    cache_stats = {"cache_hits": 0, "cache_misses": 0, "coalesced": 0}
+    errors = []
+
+    async def found():
+        async for i, track, video_id, error in iter_resolved(youtube, to_add, cache_stats):
+            if job:
+                job.advance()
+                if error:
+                    job.emit("track", index=i, query=track.query, error=error)
+            if error:
+                errors.append(error)
+            else:
+                yield track, video_id
+
+    def on_added(n):
+        if job:
+            job.emit("batch", added=n, done=job.done, total=job.total)
+
+    migrated, insert_errors = await add_resolved_tracks(youtube, playlist_id, found(), on_added)
+
+    return playlist_name, {
+        "playlist_url": f"https://www.youtube.com/playlist?list={playlist_id}",
+        "total_songs": len(tracks),
+        "migrated_count": migrated,
+        "already_synced": len(already),
+        "errors": errors + insert_errors,
+        **cache_stats,
+    }
+
+
+async def migrate_playlist(youtube: AsyncYouTube, apple_url: str, job=None, playlist_id: str = None):
+    _, result = await _migrate(youtube, apple_url, job, playlist_id)
+    return result
+
+
+async def migrate_playlists(youtube: AsyncYouTube, apple_urls: list, job=None):
+    """Async migrate_playlists: up to ASYNC_BULK_CONCURRENCY playlists are migrated at a time."""
+    apple_urls = list(dict.fromkeys(apple_urls))
+    limit = asyncio.Semaphore(ASYNC_BULK_CONCURRENCY)
+    if job:
+        job.set_stage("migrating playlists", total=len(apple_urls))
+
+    async def migrate_one(url: str):
+        async with limit:
+            try:
+                name, result = await _migrate(youtube, url)
+                item = {"apple_url": url, "name": name, **result}
+            except MigrationError as e:
+                item = {"apple_url": url, "error": str(e)}
+            except Exception as e:
+                app.logger.exception("Bulk migration failed for %s", url)
+                item = {"apple_url": url, "error": f"Unexpected error: {e}"}
+        if job:
+            job.advance()
+            job.emit("playlist", result=item)
+        return item
+
+    playlists = await asyncio.gather(*(migrate_one(url) for url in apple_urls))
+    done = [p for p in playlists if "error" not in p]
+    return {
+        "playlists": playlists,
+        "total_songs": sum(p["total_songs"] for p in done),
+        "migrated_count": sum(p["migrated_count"] for p in done),
+        "errors": [],
+    }
+
+
+# --- Background Jobs ---
+
+@functools.lru_cache(maxsize=None)
+def get_admission_control() -> migrator.AdmissionControl:
+    return migrator.AdmissionControl(
+        ASYNC_MAX_RUNNING_MIGRATIONS, migrator.MAX_QUEUED_MIGRATIONS, migrator.MAX_USER_MIGRATIONS
+    )
+
+
+async def _run_job(job: migrator.Job, youtube: AsyncYouTube):
+    # the job stays "queued" until a slot frees up
+    async with _running:
+        with migrator.running_job(job):
+            if job.apple_urls:
+                job.finish(result=await migrate_playlists(youtube, job.apple_urls, job))
+            else:
+                job.finish(result=await migrate_playlist(youtube, job.apple_url, job, playlist_id=job.playlist_id))
+
+
+def submit_job(youtube: AsyncYouTube, apple_url: str = None, playlist_id: str = None, apple_urls: list = None):
+    """Start a migration as a task on the event loop and return its job immediately."""
+    job = migrator.register_job(migrator.Job(apple_url, playlist_id, apple_urls))
+    _spawn(_run_job(job, youtube))
+    return job
+
+
+# --- Quart Routes ---
+
+@app.route("/")
+async def index():
+    return await render_template("index.html")
+
+
+@app.route("/migrate", methods=["POST"])
+async def migrate():
+    form = await request.form
+    try:
+        error = migrator.stage_migration(form, session, get_admission_control())
+    except MigrationRejected as e:
+        return migrator.rejected_response(e, request.accept_mimetypes.best == "application/json", url_for)
+    if error:
+        return error, 400
+    flow = migrator.oauth_flow(url_for("oauth2callback", _external=True))
+
+    auth_url, state = flow.authorization_url(
+        access_type="offline", include_granted_scopes="true"
+    )
+    session["state"] = state
+    return redirect(auth_url)
+
+
+@app.route("/oauth2callback")
+async def oauth2callback():
+    state = session.get("state")
+    if not state:
+        return redirect(url_for("index"))
+
+    flow = migrator.oauth_flow(url_for("oauth2callback", _external=True), state=state)
+
+    # the code exchange is one request per sign-in; oauthlib only offers it blocking
+    await asyncio.to_thread(flow.fetch_token, authorization_response=request.url)
+    # credentials stay server-side; the cookie only names the user
+    user_id = session.get("user_id") or uuid.uuid4().hex
+    migrator.get_credential_store().put(user_id, flow.credentials)
+    session["user_id"] = user_id
+    return redirect(url_for("process_playlist"))
+
+
+@app.route("/process")
+async def process_playlist():
+    creds = migrator.get_credential_store().credentials(session["user_id"]) if "user_id" in session else None
+    if creds is None or not migrator.has_pending_migration(session):
+        # a refresh after the job was queued should not start it again
+        if session.get("job_id") and migrator.get_job(session["job_id"]):
+            return redirect(url_for("job_page", job_id=session["job_id"]))
+        return redirect(url_for("index"))
+
+    wants_json = request.accept_mimetypes.best == "application/json"
+    submit = functools.partial(submit_job, AsyncYouTube(creds))
+    try:
+        job = migrator.start_pending_migration(session, get_admission_control(), submit)
+    except MigrationRejected as e:
+        return migrator.rejected_response(e, wants_json, url_for)
+    if job is None:
+        return redirect(url_for("index"))
+
+    if wants_json:
+        return {"job_id": job.id, "status_url": url_for("job_status", job_id=job.id)}, 202
+    return redirect(url_for("job_page", job_id=job.id))
+
+
+@app.route("/jobs/<job_id>")
+async def job_page(job_id):
+    job = migrator.get_job(job_id)
+    if not job:
+        abort(404)
+    if job.status == "failed":
+        return await render_template("results.html", error=job.error)
+    return await render_template("results.html", job=job.to_dict(), **(job.result or {}))
+
+
+@app.route("/jobs/<job_id>/events")
+async def job_events(job_id):
+    """Stream the job's progress as Server-Sent Events without holding a thread per stream."""
+    job = migrator.get_job(job_id)
+    if not job:
+        return jsonify({"error": "Unknown job id."}), 404
+    start = migrator.replay_start(request.headers.get("Last-Event-ID"))
+    loop = asyncio.get_running_loop()
+    woken = asyncio.Event()
+
+    def wake():
+        # jobs may emit from worker threads
+        loop.call_soon_threadsafe(woken.set)
+
+    async def stream():
+        job.subscribe(wake)
+        try:
+            index, done = start, None
+            while True:
+                woken.clear()
+                events = job.wait_for_events(index, timeout=0)
+                for event in events:
+                    yield f"id: {event['id']}\nevent: {event['event']}\ndata: {json.dumps(event['data'])}\n\n"
+                index += len(events)
+                if job.done != done:
+                    done = job.done
+                    yield job.progress_event()
+                elif not events:
+                    if job.finished:
+                        return
+                    try:
+                        await asyncio.wait_for(woken.wait(), 15)
+                    except asyncio.TimeoutError:
+                        yield ": keep-alive\n\n"
+        finally:
+            job.unsubscribe(wake)
+
+    response = Response(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    response.timeout = None  # the stream lasts as long as the job
+    return response
+
+
+@app.route("/jobs/<job_id>/status")
+async def job_status(job_id):
+    job = migrator.get_job(job_id)
+    if not job:
+        return jsonify({"error": "Unknown job id."}), 404
+    return jsonify(job.to_dict())
+
+
+@app.route("/metrics")
+async def metrics():
+    return Response(migrator.generate_latest(), mimetype=migrator.CONTENT_TYPE_LATEST)
+
+
+if __name__ == "__main__":
+    port = int(os.environ.get("PORT", 8080))
+    app.run(host="0.0.0.0", port=port, debug=True)
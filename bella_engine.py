@@ -0,0 +1,410 @@
+"""Bella's inference engine: continuous batching over one llama.cpp context.
+
+modal-chatbot.py loads the model and serves it; this module holds the
+scheduler and its KV cache bookkeeping, and ships in the Modal image next
+to it so it can be imported (and tested) without modal or gradio.
+"""
+import codecs
+import collections
+import hashlib
+import itertools
+import os
+import queue
+import threading
+import time
+import llama_cpp
+import numpy as np
+
+STOP_TOKENS = ["<|im_end|>", "</s>", "<|end_of_text|>"]
+MAX_QUEUED_REQUESTS = int(os.environ.get("MAX_QUEUED_REQUESTS", 32)) # Beyond this, requests are turned away
+PRIORITY_CHAT = 0 # Someone is watching tokens stream in
+PRIORITY_API = 1
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", 4)) # Conversations decoded together; 1 turns batching off
+BATCH_WAIT_MS = int(os.environ.get("BATCH_WAIT_MS", 20)) # How long an idle engine waits for more requests to batch
+CONTEXT_PER_SEQUENCE = 4096 # Each conversation's share of the KV cache
+PREFIX_CACHE_SLOTS = int(os.environ.get("PREFIX_CACHE_SLOTS", 8)) # Distinct system prompts kept evaluated
+PREFIX_CACHE_TOKENS = int(os.environ.get("PREFIX_CACHE_TOKENS", 4096)) # KV cache set aside for them
+SESSION_CACHE_SLOTS = int(os.environ.get("SESSION_CACHE_SLOTS", 16)) # Idle conversations kept evaluated between turns
+SESSION_CACHE_TOKENS = int(os.environ.get("SESSION_CACHE_TOKENS", 16384)) # KV cache set aside for them
+WINDOW_LOW_WATER = 0.75 # An overflowing conversation drops old turns until it fits in this share of its budget
+# Sampling, as create_chat_completion was called with (plus its top_k/min_p defaults)
+TEMPERATURE = 0.7
+TOP_P = 0.9
+TOP_K = 40
+MIN_P = 0.05
+REPEAT_PENALTY = 1.1
+REPEAT_LAST_N = 64
+
+def chatml(messages):
+    # MiniCPM-V 2.6 is Qwen2 based and uses the ChatML template its GGUF ships with.
+    # Returns (system prompt, [turn, ..., assistant header]) so the system part can be cached
+    # on its own and old turns dropped one by one.
+    messages = [m for m in messages if isinstance(m["content"], str)]
+    turns = [f"<|im_start|>{m['role']}\n{m['content']}<|im_end|>\n" for m in messages]
+    n_system = 1 if messages and messages[0]["role"] == "system" else 0
+    return "".join(turns[:n_system]), turns[n_system:] + ["<|im_start|>assistant\n"]
+
+def common_prefix_length(a, b):
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+def sample_token(logits, recent, rng):
+    # repeat penalty -> top-k -> top-p -> min-p -> temperature, like llama.cpp's default sampler chain
+    logits = logits.astype(np.float32)
+    if recent:
+        ids = np.fromiter(set(recent), dtype=np.intp)
+        penalized = logits[ids]
+        logits[ids] = np.where(penalized > 0, penalized / REPEAT_PENALTY, penalized * REPEAT_PENALTY)
+    top = np.argpartition(logits, -TOP_K)[-TOP_K:] # O(vocab); only these 40 get sorted
+    top = top[np.argsort(-logits[top])]
+    probs = np.exp(logits[top] - logits[top[0]])
+    probs /= probs.sum()
+    keep = int(np.searchsorted(np.cumsum(probs), TOP_P)) + 1
+    keep = min(keep, int((probs >= MIN_P * probs[0]).sum()))
+    top = top[:max(keep, 1)]
+    probs = np.exp((logits[top] - logits[top[0]]) / TEMPERATURE)
+    return int(rng.choice(top, p=probs / probs.sum()))
+
+class CancellationToken:
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+class EngineBusy(Exception):
+    pass
+
+class InferenceRequest:
+    _DONE = object()
+
+    def __init__(self, messages, max_tokens, token, session_id=None):
+        self.messages = messages
+        self.max_tokens = max_tokens
+        self.token = token
+        self.session_id = session_id # Keeps the conversation's KV state for its next turn
+        self.submitted = time.perf_counter()
+        self.started = None # When the worker took it off the queue
+        self.first_token = None
+        self.output = queue.Queue() # Text deltas from the worker, then _DONE or an exception
+
+    def stream(self, timeout=None):
+        # Yields text as it is generated; stopping early (e.g. the browser went away) cancels the request
+        try:
+            while True:
+                item = self.output.get(timeout=timeout)
+                if item is self._DONE:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        except queue.Empty:
+            raise TimeoutError(f"No answer within {timeout}s")
+        finally:
+            self.token.cancel()
+
+    def result(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        parts = []
+        for delta in self.stream(timeout):
+            parts.append(delta)
+            if deadline and time.monotonic() > deadline:
+                raise TimeoutError(f"No answer within {timeout}s")
+        return "".join(parts)
+
+class SequenceCache:
+    """Evaluated token sequences kept in the KV cache after their request, by key.
+
+    Used for system prompts, keyed by a hash of the rendered prefix so each
+    one, the default or a custom one, is evaluated once; and for
+    conversations between turns, keyed by session. Each entry is a sequence
+    of its own in the KV cache: copy_to shares its cells with a new
+    request's sequence (kv_cache_seq_cp does not duplicate them). Least
+    recently used entries are dropped to stay within the slots and tokens
+    set aside for the cache.
+    """
+
+    def __init__(self, llm, seq_ids, max_tokens):
+        self.llm = llm
+        self.max_tokens = max_tokens
+        self.n_tokens = 0
+        self.hits = 0
+        self.misses = 0
+        self._free_seq_ids = list(seq_ids)
+        self._entries = collections.OrderedDict() # Key -> (seq_id, n_tokens, data)
+
+    def copy_to(self, key, seq_id, take=False):
+        # Returns (n_tokens, data) after copying key's tokens into seq_id, or None; take also drops the entry
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        self.llm._ctx.kv_cache_seq_cp(entry[0], seq_id, -1, -1)
+        if take:
+            self._drop(key)
+        return entry[1], entry[2]
+
+    def store(self, key, seq_id, n_tokens, data=None):
+        # Keeps the first n_tokens of seq_id under key
+        if key in self._entries:
+            self._drop(key)
+        if n_tokens > self.max_tokens:
+            return
+        while self._entries and (not self._free_seq_ids or self.n_tokens + n_tokens > self.max_tokens):
+            self._drop(next(iter(self._entries)))
+        if not self._free_seq_ids:
+            return
+        cache_seq_id = self._free_seq_ids.pop()
+        self.llm._ctx.kv_cache_seq_cp(seq_id, cache_seq_id, 0, n_tokens)
+        self._entries[key] = (cache_seq_id, n_tokens, data)
+        self.n_tokens += n_tokens
+
+    def _drop(self, key):
+        cache_seq_id, n_tokens, _ = self._entries.pop(key)
+        self.llm._ctx.kv_cache_seq_rm(cache_seq_id, -1, -1)
+        self._free_seq_ids.append(cache_seq_id)
+        self.n_tokens -= n_tokens
+
+class _Sequence:
+    # One request being generated, occupying seq_id in the KV cache
+    def __init__(self, request, seq_id):
+        self.request = request
+        self.seq_id = seq_id
+        self.tokens = [] # What this sequence holds in the KV cache
+        self.next_token = None # Sampled but not yet decoded
+        self.first_turn = 0 # Turns before this one were dropped to fit the context
+        self.recent = []
+        self.generated = 0
+        self.text = codecs.getincrementaldecoder("utf-8")(errors="replace") # Tokens can split a character
+
+def sequences_needed(batch_size=BATCH_MAX_SIZE):
+    # Sequence ids the engine hands out: one per running request, then the prefix and session caches
+    return batch_size + PREFIX_CACHE_SLOTS + SESSION_CACHE_SLOTS
+
+class InferenceEngine:
+    """Owns the model and generates for up to BATCH_MAX_SIZE requests at once.
+
+    Both front ends submit here, so the model is loaded once per container.
+    Requests wait in a bounded priority queue; a worker thread moves them
+    into the running batch as slots free up (continuous batching) and
+    decodes one token of every running sequence per llama_decode call, each
+    sequence in its own slot of the shared KV cache. A request that arrives
+    at an idle engine waits up to BATCH_WAIT_MS for others to join it.
+
+    A request with a session_id leaves its conversation in the KV cache when
+    it finishes, so the session's next turn only evaluates what is new.
+    """
+
+    def __init__(self, llm, max_queued=MAX_QUEUED_REQUESTS, batch_size=BATCH_MAX_SIZE, batch_wait_ms=BATCH_WAIT_MS):
+        n_seq_max = llama_cpp.llama_n_seq_max(llm._ctx.ctx)
+        if n_seq_max < sequences_needed(batch_size):
+            raise ValueError(f"The context was built for {n_seq_max} sequences, the engine needs {sequences_needed(batch_size)}")
+        self.llm = llm
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait_ms / 1000
+        self._queue = queue.PriorityQueue(maxsize=max_queued)
+        self._order = itertools.count() # FIFO within a priority
+        self._free_seq_ids = list(range(batch_size))
+        seq_ids = itertools.count(batch_size)
+        self._prefixes = SequenceCache(llm, itertools.islice(seq_ids, PREFIX_CACHE_SLOTS), PREFIX_CACHE_TOKENS)
+        self._sessions = SequenceCache(llm, itertools.islice(seq_ids, SESSION_CACHE_SLOTS), SESSION_CACHE_TOKENS)
+        self._bos = llm.tokenize(b"", add_bos=True, special=True) # [] for models without one
+        self._rng = np.random.default_rng()
+        self._n_vocab = llm.n_vocab()
+        self._batch = llama_cpp.llama_batch_init(max(llm.n_batch, batch_size), 0, 1)
+        self._stop_ids = {llm.token_eos()}
+        for stop in STOP_TOKENS:
+            ids = llm.tokenize(stop.encode(), add_bos=False, special=True)
+            if len(ids) == 1:
+                self._stop_ids.add(ids[0])
+        self._stats_lock = threading.Lock()
+        self._tokens = 0
+        self._steps = 0
+        self._decode_seconds = 0.0
+        llm._ctx.kv_cache_clear() # Drop whatever warm-up left behind
+        threading.Thread(target=self._worker, name="inference", daemon=True).start()
+
+    def submit(self, messages, max_tokens, priority=PRIORITY_API, token=None, session_id=None):
+        request = InferenceRequest(messages, max_tokens, token or CancellationToken(), session_id)
+        try:
+            self._queue.put_nowait((priority, next(self._order), request))
+        except queue.Full:
+            raise EngineBusy("Bella is busy right now. Please try again in a moment.") from None
+        return request
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "tokens": self._tokens,
+                "tokens_per_second": round(self._tokens / self._decode_seconds, 1) if self._decode_seconds else None,
+                "mean_batch_size": round(self._tokens / self._steps, 2) if self._steps else None,
+                "prefix_hits": self._prefixes.hits,
+                "prefix_misses": self._prefixes.misses,
+                "session_hits": self._sessions.hits,
+                "session_misses": self._sessions.misses,
+                "queued": self._queue.qsize()
+            }
+
+    def _worker(self):
+        running = []
+        while True:
+            for request in self._take_requests(self.batch_size - len(running), wait=not running):
+                sequence = self._start(request)
+                if sequence:
+                    running.append(sequence)
+            for sequence in [s for s in running if s.request.token.cancelled]: # Stop generating for nobody
+                self._release(running, sequence)
+            if running:
+                try:
+                    self._step(running)
+                except Exception as e:
+                    for sequence in list(running):
+                        sequence.request.output.put(e)
+                        self._release(running, sequence)
+
+    def _take_requests(self, slots, wait):
+        # Idle: block for one request, then give others BATCH_WAIT_MS to arrive. Busy: only what is already queued.
+        requests = []
+        deadline = None
+        while len(requests) < slots:
+            try:
+                if wait and not requests:
+                    _, _, request = self._queue.get()
+                    deadline = time.monotonic() + self.batch_wait
+                elif deadline:
+                    _, _, request = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                else:
+                    _, _, request = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if not request.token.cancelled: # Gave up while queued
+                requests.append(request)
+        return requests
+
+    def _start(self, request):
+        request.started = time.perf_counter()
+        sequence = _Sequence(request, self._free_seq_ids.pop())
+        try:
+            if self._prefill_prompt(sequence):
+                return sequence
+            self._finish(sequence)
+        except Exception as e:
+            request.output.put(e)
+        self.llm._ctx.kv_cache_seq_rm(sequence.seq_id, -1, -1)
+        self._free_seq_ids.append(sequence.seq_id)
+        return None
+
+    def _prefill_prompt(self, sequence):
+        # Evaluates whatever of the prompt is not already cached and samples the first token
+        request = sequence.request
+        system, turns = chatml(request.messages)
+        session = self._sessions.copy_to(request.session_id, sequence.seq_id, take=True) if request.session_id else None
+        cached_tokens, sequence.first_turn = session[1] if session else ([], 0)
+
+        prefix = self._bos + self.llm.tokenize(system.encode(), add_bos=False, special=True)
+        turn_tokens = [self.llm.tokenize(turn.encode(), add_bos=False, special=True) for turn in turns]
+        budget = CONTEXT_PER_SEQUENCE - request.max_tokens
+        # Sliding window: once the conversation outgrows its budget, drop its oldest turns until it is back
+        # under the low-water mark, so the next few turns again only add to what is cached
+        sequence.first_turn = min(sequence.first_turn, len(turns) - 2) if len(turns) > 2 else 0
+        n_prompt = len(prefix) + sum(len(t) for t in turn_tokens[sequence.first_turn:])
+        if n_prompt > budget:
+            while sequence.first_turn < len(turns) - 2 and n_prompt > budget * WINDOW_LOW_WATER:
+                n_prompt -= len(turn_tokens[sequence.first_turn])
+                sequence.first_turn += 1
+        if n_prompt > budget:
+            raise ValueError(f"The message is too long ({n_prompt} tokens). Please shorten it.")
+        prompt = prefix + [token for tokens in turn_tokens[sequence.first_turn:] for token in tokens]
+
+        if session:
+            # Keep the cached tokens this prompt starts with; at least one is left to evaluate for its logits
+            sequence.tokens = prompt[:min(common_prefix_length(cached_tokens, prompt), len(prompt) - 1)]
+            self.llm._ctx.kv_cache_seq_rm(sequence.seq_id, len(sequence.tokens), -1)
+        elif system:
+            key = hashlib.sha256(system.encode()).hexdigest()
+            if self._prefixes.copy_to(key, sequence.seq_id):
+                sequence.tokens = list(prefix)
+            else:
+                self._prefill(sequence, prefix)
+                self._prefixes.store(key, sequence.seq_id, len(prefix))
+        return self._accept(sequence, self._sample(sequence, self._prefill(sequence, prompt[len(sequence.tokens):])))
+
+    def _prefill(self, sequence, tokens):
+        # Tokens go through in n_batch sized chunks; returns the batch index holding the last one's logits
+        for chunk_start in range(0, len(tokens), self.llm.n_batch):
+            chunk = tokens[chunk_start:chunk_start + self.llm.n_batch]
+            for i, token in enumerate(chunk):
+                self._add(i, token, len(sequence.tokens) + i, sequence.seq_id, chunk_start + i == len(tokens) - 1)
+            self._decode(len(chunk))
+            sequence.tokens += chunk
+        return len(chunk) - 1
+
+    def _step(self, running):
+        started = time.perf_counter()
+        n_tokens = len(running)
+        for i, sequence in enumerate(running):
+            self._add(i, sequence.next_token, len(sequence.tokens), sequence.seq_id, True)
+        self._decode(n_tokens)
+        for i, sequence in enumerate(list(running)):
+            sequence.tokens.append(sequence.next_token)
+            if not self._accept(sequence, self._sample(sequence, i)):
+                self._finish(sequence)
+                self._release(running, sequence)
+        with self._stats_lock:
+            self._tokens += n_tokens
+            self._steps += 1
+            self._decode_seconds += time.perf_counter() - started
+
+    def _add(self, i, token, pos, seq_id, logits):
+        batch = self._batch
+        batch.token[i] = token
+        batch.pos[i] = pos
+        batch.n_seq_id[i] = 1
+        batch.seq_id[i][0] = seq_id
+        batch.logits[i] = logits
+
+    def _decode(self, n_tokens):
+        self._batch.n_tokens = n_tokens
+        status = llama_cpp.llama_decode(self.llm._ctx.ctx, self._batch)
+        if status != 0:
+            raise RuntimeError(f"llama_decode failed ({status})")
+
+    def _sample(self, sequence, i):
+        logits = np.ctypeslib.as_array(llama_cpp.llama_get_logits_ith(self.llm._ctx.ctx, i), shape=(self._n_vocab,))
+        return sample_token(logits, sequence.recent[-REPEAT_LAST_N:], self._rng)
+
+    def _accept(self, sequence, token):
+        # Streams the token's text; False once the sequence is finished
+        if token in self._stop_ids:
+            return False
+        sequence.next_token = token
+        sequence.recent.append(token)
+        sequence.generated += 1
+        if sequence.generated == 1:
+            sequence.request.first_token = time.perf_counter()
+        text = sequence.text.decode(self.llm.detokenize([token]))
+        if text:
+            sequence.request.output.put(text)
+        return sequence.generated < sequence.request.max_tokens
+
+    def _finish(self, sequence):
+        if sequence.request.session_id:
+            self._sessions.store(
+                sequence.request.session_id, sequence.seq_id, len(sequence.tokens),
+                (sequence.tokens, sequence.first_turn)
+            )
+        sequence.request.output.put(InferenceRequest._DONE)
+
+    def _release(self, running, sequence):
+        running.remove(sequence)
+        self.llm._ctx.kv_cache_seq_rm(sequence.seq_id, -1, -1)
+        self._free_seq_ids.append(sequence.seq_id)
@@ -0,0 +1,63 @@
+"""A local stand-in for music.apple.com that serves synthetic playlist pages.
+
+    python -m bench.fake_apple [--port 8601]
+
+GET /us/playlist/<name>/pl.<tracks>-<seed> returns a page with <tracks>
+tracks (see bench.fixtures). Pages carry an ETag and honour
+If-None-Match, like the real site's CDN.
+"""
+import argparse
+import functools
+import hashlib
+import re
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from bench.fixtures import synthetic_playlist_page
+
+_PLAYLIST_PATH = re.compile(r"^/us/playlist/[^/]+/pl\.(\d+)-(\d+)/?$")
+
+
+def playlist_url(base_url: str, n_tracks: int, seed: int = 0) -> str:
+    return f"{base_url.rstrip('/')}/us/playlist/bench-{n_tracks}/pl.{n_tracks}-{seed}"
+
+
+@functools.lru_cache(maxsize=64)
+def _page(n_tracks: int, seed: int):
+    page = synthetic_playlist_page(n_tracks, seed)
+    return page, '"%s"' % hashlib.sha1(page).hexdigest()
+
+
+class FakeAppleMusicHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        m = _PLAYLIST_PATH.match(self.path.split("?", 1)[0])
+        if not m:
+            self.send_error(404)
+            return
+        page, etag = _page(int(m.group(1)), int(m.group(2)))
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(page)))
+        self.end_headers()
+        self.wfile.write(page)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port: int):
+    ThreadingHTTPServer(("127.0.0.1", port), FakeAppleMusicHandler).serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8601)
+    serve(parser.parse_args().port)
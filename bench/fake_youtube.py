@@ -0,0 +1,139 @@
+"""A local stand-in for the YouTube Data API with configurable latency and errors.
+
+    python -m bench.fake_youtube [--port 8602] [--latency-ms 50] [--error-rate 0.01]
+
+Implements the calls the migrator makes: search.list, videos.list,
+playlists.insert and playlistItems.list/insert. Point the app at it with
+YOUTUBE_API_ROOT=http://127.0.0.1:<port>/. Every call sleeps for about
+--latency-ms and fails with a retryable 503 at --error-rate.
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import random
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_BACKEND_ERROR = {"error": {"code": 503, "message": "Backend Error", "errors": [{"reason": "backendError"}]}}
+
+
+def video_id_for(query: str, rank: int = 0) -> str:
+    return hashlib.sha1(f"{query}\x00{rank}".encode()).hexdigest()[:11]
+
+
+class FakeYouTube:
+    """In-memory playlists plus the call semantics the migrator relies on."""
+
+    def __init__(self, latency: float, error_rate: float):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.playlists = {}
+        self.calls = 0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def call(self, method: str, path: str, query: dict, body: dict):
+        """Handle one API call and return (status, response body)."""
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(random.uniform(0.5, 1.5) * self.latency)
+        if random.random() < self.error_rate:
+            return 503, _BACKEND_ERROR
+        handler = getattr(self, f"_{method.lower()}_{path.rsplit('/', 1)[-1]}", None)
+        if not path.startswith("/youtube/v3/") or handler is None:
+            return 404, {"error": {"code": 404, "message": f"No fake for {method} {path}"}}
+        return handler(query, body)
+
+    def _get_search(self, query, body):
+        q = query.get("q", "")
+        items = [
+            {
+                "id": {"kind": "youtube#video", "videoId": video_id_for(q, rank)},
+                "snippet": {
+                    "title": q.split(" by ")[0] + (f" (cover {rank})" if rank else " (Official Video)"),
+                    "channelTitle": q.rsplit(" by ", 1)[-1] + (" Fans" if rank else " - Topic"),
+                },
+            }
+            for rank in range(int(query.get("maxResults", 5)))
+        ]
+        return 200, {"items": items}
+
+    def _get_videos(self, query, body):
+        items = [
+            {"id": vid, "contentDetails": {"duration": f"PT{120 + int(vid, 16) % 240}S"}}
+            for vid in query.get("id", "").split(",") if vid
+        ]
+        return 200, {"items": items}
+
+    def _post_playlists(self, query, body):
+        playlist_id = f"PLbench{next(self._ids)}"
+        with self._lock:
+            self.playlists[playlist_id] = []
+        return 200, {"id": playlist_id, "snippet": body.get("snippet", {})}
+
+    def _get_playlistItems(self, query, body):
+        with self._lock:
+            videos = list(self.playlists.get(query.get("playlistId"), ()))
+        start = int(query.get("pageToken") or 0)
+        size = int(query.get("maxResults", 5))
+        resp = {"items": [{"contentDetails": {"videoId": v}} for v in videos[start:start + size]]}
+        if start + size < len(videos):
+            resp["nextPageToken"] = str(start + size)
+        return 200, resp
+
+    def _post_playlistItems(self, query, body):
+        snippet = body["snippet"]
+        with self._lock:
+            if snippet["playlistId"] not in self.playlists:
+                return 404, {"error": {"code": 404, "message": "Playlist not found"}}
+            self.playlists[snippet["playlistId"]].append(snippet["resourceId"]["videoId"])
+        return 200, {"id": f"PLI{next(self._ids)}", "snippet": snippet}
+
+
+class FakeYouTubeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    api: FakeYouTube = None
+
+    def _body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _send(self, status: int, body: bytes):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, method: str):
+        url = urllib.parse.urlsplit(self.path)
+        raw = self._body()
+        body = json.loads(raw) if raw else {}
+        status, resp = self.api.call(method, url.path, dict(urllib.parse.parse_qsl(url.query)), body)
+        self._send(status, json.dumps(resp).encode())
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port: int, latency: float = 0.05, error_rate: float = 0.0):
+    handler = type("Handler", (FakeYouTubeHandler,), {"api": FakeYouTube(latency, error_rate)})
+    ThreadingHTTPServer(("127.0.0.1", port), handler).serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8602)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    serve(args.port, args.latency_ms / 1000, args.error_rate)
@@ -0,0 +1,73 @@
+"""Synthetic Apple Music playlist pages for the benchmarks.
+
+Pages mimic the shape of music.apple.com playlist pages: a server-rendered
+track list in the DOM plus the same data embedded as JSON in
+<script id="serialized-server-data">. They are written to bench/fixtures/
+on first use so repeated runs parse identical bytes.
+"""
+import html
+import json
+import os
+import random
+
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+
+_WORDS = ["love", "night", "fire", "heart", "blue", "summer", "dream", "city", "gold", "rain"]
+
+
+def synthetic_tracks(n_tracks: int, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    return [
+        {
+            "title": f"{rng.choice(_WORDS).title()} {rng.choice(_WORDS)} {i}",
+            "artistName": f"Artist {rng.randrange(max(n_tracks // 5, 1))}",
+            "albumName": f"Album {rng.randrange(max(n_tracks // 10, 1))}",
+            "duration": rng.randrange(120_000, 360_000),
+            "isrc": f"US{rng.randrange(10**9):010d}",
+            "artwork": {"url": f"https://is1-ssl.mzstatic.com/image/{i}/{{w}}x{{h}}bb.jpg", "width": 3000},
+        }
+        for i in range(n_tracks)
+    ]
+
+
+def synthetic_playlist_page(n_tracks: int, seed: int = 0) -> bytes:
+    tracks = synthetic_tracks(n_tracks, seed)
+    data = [
+        {
+            "data": {
+                "name": f"Synthetic Playlist ({n_tracks} tracks)",
+                "sections": [
+                    {"itemKind": "containerDetailHeaderLockup", "items": [{"title": "Header"}]},
+                    {"itemKind": "trackLockup", "items": tracks},
+                ],
+            },
+            "intent": {"$kind": "PlaylistPageIntent", "id": "pl.synthetic"},
+        },
+        {"data": {"sections": []}, "intent": {"$kind": "FooterIntent"}},
+    ]
+    rows = "\n".join(
+        f'<div class="songs-list-row" role="row"><div class="songs-list-row__song-name">'
+        f'{html.escape(t["title"])}</div><div class="songs-list-row__by-line">'
+        f'<span><a href="/artist/{j}">{html.escape(t["artistName"])}</a></span></div>'
+        f'<time datetime="PT{t["duration"] // 1000}S"></time></div>'
+        for j, t in enumerate(tracks)
+    )
+    page = (
+        "<!DOCTYPE html><html><head><meta charset=\"utf-8\"><title>Playlist</title>"
+        "<script type=\"module\" src=\"/assets/index.js\"></script>"
+        "<script>window.__config = {\"locale\": \"en-us\"};</script></head>"
+        f"<body><main><div class=\"songs-list\">{rows}</div></main>"
+        "<script type=\"application/json\" id=\"serialized-server-data\">"
+        f"{json.dumps(data)}</script></body></html>"
+    )
+    return page.encode("utf-8")
+
+
+def fixture_path(n_tracks: int) -> str:
+    """Path of the saved page for n_tracks, generating it on first use."""
+    path = os.path.join(FIXTURE_DIR, f"playlist-{n_tracks}.html")
+    if not os.path.exists(path):
+        os.makedirs(FIXTURE_DIR, exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(synthetic_playlist_page(n_tracks))
+    return path
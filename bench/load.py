@@ -0,0 +1,176 @@
+"""Offline load test of the whole migration path against local stand-ins.
+
+    python -m bench.load [--sizes 10 100 1000] [--users 4] [--migrations 8]
+                         [--latency-ms 50] [--error-rate 0.01] [--same-playlist]
+
+Starts the fake Apple Music and YouTube servers (bench.fake_apple,
+bench.fake_youtube) in child processes, serves app.py in this process with
+Google OAuth stubbed out, and has --users virtual users drive --migrations
+migrations per playlist size through /migrate -> /oauth2callback ->
+/process -> /jobs/<id>/status like a browser would. Reports tracks per
+second, p50/p99 end-to-end migration latency and the process's peak RSS.
+
+By default every migration gets a different playlist, so caches start
+cold; --same-playlist sends every user the same one instead.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import resource
+import socket
+import statistics
+import tempfile
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from bench import fake_apple, fake_youtube
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_for_port(port: int, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"nothing listening on port {port}")
+
+
+def start_fakes(latency: float, error_rate: float):
+    """Start both fakes in child processes and return their base URLs."""
+    apple_port, youtube_port = _free_port(), _free_port()
+    for target, args in (
+        (fake_apple.serve, (apple_port,)),
+        (fake_youtube.serve, (youtube_port, latency, error_rate)),
+    ):
+        multiprocessing.Process(target=target, args=args, daemon=True).start()
+    _wait_for_port(apple_port)
+    _wait_for_port(youtube_port)
+    return f"http://127.0.0.1:{apple_port}", f"http://127.0.0.1:{youtube_port}/"
+
+
+class StubFlow:
+    """Stands in for google_auth_oauthlib's Flow: consent is granted at once."""
+
+    def __init__(self, redirect_uri, state=None):
+        self.scopes = ["https://www.googleapis.com/auth/youtube.force-ssl"]
+        self.redirect_uri = redirect_uri
+
+    def authorization_url(self, **kwargs):
+        state = os.urandom(8).hex()
+        return f"{self.redirect_uri}?state={state}&code=bench", state
+
+    def fetch_token(self, authorization_response=None):
+        pass
+
+    @property
+    def credentials(self):
+        from google.oauth2.credentials import Credentials
+
+        return Credentials(
+            token="bench-token",
+            token_uri="https://oauth2.googleapis.com/token",
+            client_id="bench",
+            client_secret="bench",
+            scopes=self.scopes,
+        )
+
+
+def start_app(youtube_root: str, cache_path: str) -> str:
+    """Import app.py configured for the fakes, serve it on a local port and return its URL."""
+    os.environ.update(
+        YOUTUBE_API_ROOT=youtube_root,
+        CACHE_DB_PATH=cache_path,
+        GOOGLE_CLIENT_SECRET_JSON="{}",
+        # the fakes have no quota; keep the scheduler from pacing the run
+        YOUTUBE_DAILY_QUOTA=str(10**12),
+        QUOTA_BURST=str(10**10),
+        LOG_LEVEL="WARNING",
+    )
+    import app
+    from werkzeug.serving import make_server
+
+    app.oauth_flow = StubFlow
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    port = _free_port()
+    server = make_server("127.0.0.1", port, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{port}"
+
+
+def run_migration(app_url: str, apple_url: str, poll_interval: float = 0.05):
+    """Drive one migration like a browser. Returns (seconds, job status dict)."""
+    http = requests.Session()
+    start = time.perf_counter()
+    # /migrate -> stub consent -> /oauth2callback -> /process -> /jobs/<id>
+    resp = http.post(f"{app_url}/migrate", data={"apple_music_url": apple_url})
+    resp.raise_for_status()
+    status_url = urllib.parse.urljoin(resp.url + "/", "status")
+    while True:
+        job = http.get(status_url).json()
+        if job["status"] in ("done", "failed"):
+            return time.perf_counter() - start, job
+        time.sleep(poll_interval)
+
+
+def run_size(app_url: str, apple_base: str, size: int, users: int, migrations: int, same_playlist: bool):
+    urls = [
+        fake_apple.playlist_url(apple_base, size, seed=0 if same_playlist else seed)
+        for seed in range(migrations)
+    ]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users) as pool:
+        outcomes = list(pool.map(lambda url: run_migration(app_url, url), urls))
+    wall = time.perf_counter() - start
+
+    latencies = sorted(seconds for seconds, _ in outcomes)
+    done = [job for _, job in outcomes if job["status"] == "done"]
+    tracks = sum(job["result"]["total_songs"] for job in done)
+    cuts = statistics.quantiles(latencies, n=100, method="inclusive") if len(latencies) > 1 else latencies * 99
+    return {
+        "size": size,
+        "migrations": len(outcomes),
+        "failed": len(outcomes) - len(done),
+        "tracks_per_s": tracks / wall,
+        "p50": cuts[49],
+        "p99": cuts[98],
+        "peak_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--users", type=int, default=4)
+    parser.add_argument("--migrations", type=int, default=8, help="migrations per playlist size")
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--same-playlist", action="store_true")
+    args = parser.parse_args()
+
+    apple_base, youtube_root = start_fakes(args.latency_ms / 1000, args.error_rate)
+    with tempfile.TemporaryDirectory() as tmp:
+        app_url = start_app(youtube_root, os.path.join(tmp, "cache.sqlite3"))
+        print(f"{'tracks':>7} {'runs':>5} {'failed':>6} {'tracks/s':>9} {'p50 s':>8} {'p99 s':>8} {'peak RSS MiB':>13}")
+        for size in args.sizes:
+            r = run_size(app_url, apple_base, size, args.users, args.migrations, args.same_playlist)
+            print(
+                f"{r['size']:>7} {r['migrations']:>5} {r['failed']:>6} {r['tracks_per_s']:>9.1f}"
+                f" {r['p50']:>8.2f} {r['p99']:>8.2f} {r['peak_rss_mib']:>13.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""Benchmark the streaming embedded-JSON extractor against the BeautifulSoup parse.
+
+    python -m bench.scrape [--sizes 100 1000 10000] [--repeat 5]
+
+Both paths read the same saved fixture page and must yield the same tracks.
+Reports the best wall time and the peak traced allocation of each.
+"""
+import argparse
+import json
+import time
+import tracemalloc
+
+from bs4 import BeautifulSoup
+
+from app import find_embedded_json, iter_playlist_tracks, parse_embedded_playlist
+from bench.fixtures import fixture_path
+
+CHUNK_SIZE = 64 * 1024
+
+
+def bs4_extract(page: bytes):
+    """The pre-streaming path: full DOM parse, then json.loads of the whole script."""
+    soup = BeautifulSoup(page.decode("utf-8"), "html.parser")
+    script = soup.find("script", id="serialized-server-data") or soup.find("script", {"type": "application/json"})
+    playlist_info = json.loads(script.string)[0]["data"]
+    items = []
+    for section in playlist_info.get("sections", []):
+        if section.get("itemKind") == "trackLockup":
+            items.extend(section.get("items", []))
+    return [f"{t.get('title','Unknown Title')} by {t.get('artistName','Unknown Artist')}" for t in items]
+
+
+def stream_extract(page: bytes):
+    chunks = (page[i:i + CHUNK_SIZE] for i in range(0, len(page), CHUNK_SIZE))
+    return [t.query for t in iter_playlist_tracks(parse_embedded_playlist(find_embedded_json(chunks)))]
+
+
+def measure(fn, page: bytes, repeat: int):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(page)
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    fn(page)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, best, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'tracks':>7} {'page KiB':>9} {'bs4 ms':>9} {'stream ms':>10} {'bs4 peak MiB':>13} {'stream peak MiB':>16}")
+    for size in args.sizes:
+        with open(fixture_path(size), "rb") as f:
+            page = f.read()
+        old, old_time, old_peak = measure(bs4_extract, page, args.repeat)
+        new, new_time, new_peak = measure(stream_extract, page, args.repeat)
+        assert old == new, f"extractors disagree on the {size} track page"
+        print(
+            f"{size:>7} {len(page) / 1024:>9.0f} {old_time * 1000:>9.1f} {new_time * 1000:>10.1f}"
+            f" {old_peak / 2**20:>13.1f} {new_peak / 2**20:>16.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
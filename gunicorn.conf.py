@@ -0,0 +1,28 @@
+"""Gunicorn settings for the sync serving mode (see the Dockerfile)."""
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8080)}"
+# Migrations run on a background worker pool inside the process, so keep a single
+# worker (job state lives in memory) and give it threads for the progress streams.
+workers = 1
+# Every job admitted by app.py (running or queued) can have a results page holding a
+# thread on /jobs/<id>/events for the whole migration, so size the pool from the
+# admission capacity and keep headroom for the regular pages, callbacks and /metrics.
+threads = int(
+    os.environ.get(
+        "GUNICORN_THREADS",
+        int(os.environ.get("MIGRATION_WORKERS", 4))
+        + int(os.environ.get("MAX_QUEUED_MIGRATIONS", 32))
+        + int(os.environ.get("GUNICORN_THREAD_HEADROOM", 16)),
+    )
+)
+# Import app.py once in the master; forked workers start with it already loaded.
+preload_app = True
+
+
+def post_fork(server, worker):
+    # Threads do not survive a fork, so background work starts in the worker.
+    # app.py starts its pools and the token refresher on first use.
+    from app import start_warm_up
+
+    start_warm_up()
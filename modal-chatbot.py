@@ -8,14 +8,32 @@ from fastapi import File, UploadFile, Form
 
 from llama_cpp import Llama
 
+from llama_cpp._internals import LlamaContext
+
 import gradio as gr
 
 from PIL import Image
 
 import io
 
+import contextlib
+
+import time
+
 import fitz # Import PyMuPDF
 
+from bella_engine import (
+
+    BATCH_MAX_SIZE, BATCH_WAIT_MS, CONTEXT_PER_SEQUENCE, MAX_QUEUED_REQUESTS, PREFIX_CACHE_TOKENS,
+
+    PRIORITY_API, PRIORITY_CHAT, SESSION_CACHE_TOKENS, InferenceEngine, sequences_needed
+
+)
+
+
+
+CONTAINER_STARTED = time.perf_counter() # Module import is the start of a container
+
 
 
 MODEL_REPO = "openbmb/MiniCPM-V-2_6-gguf"
@@ -34,6 +52,10 @@ MAX_TEXT_INPUT_LENGTH = 2000 # Example: Limit text input to 2000 characters
 
 MAX_IMAGE_FILE_SIZE_MB = "10MB" # Example: Limit image file size to 10 MB
 
+WARM_UP = os.environ.get("WARM_UP", "1") == "1" # Run one tiny completion before taking requests
+
+REQUEST_TIMEOUT = int(os.environ.get("REQUEST_TIMEOUT", 300)) # Seconds ask_web waits, queueing included
+
 
 
 app = modal.App("bella-minicpm-v2")
@@ -54,7 +76,7 @@ image = (
 
     .pip_install(
 
-        "llama-cpp-python>=0.3.9",
+        "llama-cpp-python==0.3.9", # The batching engine uses its low-level API
 
         "gradio",
 
@@ -70,6 +92,10 @@ image = (
 
     )
 
+    .env({"BATCH_MAX_SIZE": str(BATCH_MAX_SIZE), "BATCH_WAIT_MS": str(BATCH_WAIT_MS)}) # Set at deploy time
+
+    .add_local_python_source("bella_engine") # The inference engine
+
 )
 
 
@@ -108,7 +134,41 @@ def download_model():
 
 
 
-@app.function(
+def load_llm():
+
+    llm = Llama(
+
+        model_path=MODEL_PATH,
+
+        n_ctx=CONTEXT_PER_SEQUENCE * BATCH_MAX_SIZE + PREFIX_CACHE_TOKENS + SESSION_CACHE_TOKENS, # One KV cache for all of it
+
+        n_gpu_layers=100, # Adjust based on your GPU setup and llama_cpp_python build
+
+        n_threads=os.cpu_count()
+
+    )
+
+    # Llama takes no n_seq_max and builds its context for one sequence, while the engine gives every
+
+    # running request, cached system prompt and idle session its own. Rebuild the context for those;
+
+    # InferenceEngine checks llama_n_seq_max and refuses to start on a context that is too small.
+
+    llm._ctx.close()
+
+    llm.context_params.n_seq_max = sequences_needed()
+
+    llm._ctx = llm._stack.enter_context(contextlib.closing(
+
+        LlamaContext(model=llm._model, params=llm.context_params, verbose=llm.verbose)
+
+    ))
+
+    return llm
+
+
+
+@app.cls(
 
     image=image,
 
@@ -122,141 +182,207 @@ def download_model():
 
 )
 
-@modal.fastapi_endpoint(method="POST")
+@modal.concurrent(max_inputs=MAX_QUEUED_REQUESTS) # Let requests reach the engine's queue
 
-def ask_web(
+class Bella:
 
-    q: str = Form(""),
+    @modal.enter()
 
-    system: str = Form(DEFAULT_SYSTEM_MESSAGE),
+    def load_model(self):
 
-    tokens: int = Form(TOKEN_LIMIT),
+        # Runs once per container; Modal sends it no requests until this returns
 
-    image_file: UploadFile = File(None),
+        load_started = time.perf_counter()
 
-    image_base64: str = Form(None)
+        llm = load_llm()
 
-):
+        self.load_seconds = time.perf_counter() - load_started
 
-    llm = Llama(
 
-        model_path=MODEL_PATH,
 
-        n_ctx=4096,
+        self.warm_up_seconds = None
 
-        n_gpu_layers=100,
+        if WARM_UP:
 
-        n_threads=os.cpu_count()
+            # The first completion pays for GPU kernel setup; pay it here instead of in a request
 
-    )
+            warm_up_started = time.perf_counter()
 
-    messages = [{"role": "system", "content": system}]
+            llm.create_chat_completion(messages=[{"role": "user", "content": "Hi"}], max_tokens=1)
 
+            self.warm_up_seconds = time.perf_counter() - warm_up_started
 
 
-    img_bytes = None
 
-    if image_file:
+        self.engine = InferenceEngine(llm) # Raises if the context lacks a sequence for any id it uses
 
-        img_bytes = image_file.file.read()
 
-    elif image_base64:
 
-        img_bytes = base64.b64decode(image_base64)
+        self.cold_start_seconds = time.perf_counter() - CONTAINER_STARTED
 
+        print(f"Model ready: cold start {self.cold_start_seconds:.1f}s, load {self.load_seconds:.1f}s, warm-up {self.warm_up_seconds or 0:.1f}s")
 
 
-    if img_bytes:
 
-        image_tag = f"<image>{base64.b64encode(img_bytes).decode()}</image>"
+    @modal.fastapi_endpoint(method="GET")
 
-        q += "\n" + image_tag
+    def health(self):
 
+        # Only answers once load_model has finished, so a 200 here means ready
 
+        return {
 
-    messages.append({"role": "user", "content": q})
+            "status": "ready",
 
-    try:
+            "cold_start_seconds": round(self.cold_start_seconds, 3),
 
-        resp = llm.create_chat_completion(
+            "load_seconds": round(self.load_seconds, 3),
 
-            messages=messages,
+            "warm_up_seconds": None if self.warm_up_seconds is None else round(self.warm_up_seconds, 3),
 
-            max_tokens=tokens,
+            "engine": self.engine.stats()
 
-            temperature=0.7,
+        }
 
-            top_p=0.9,
 
-            repeat_penalty=1.1,
 
-            stop=["<|im_end|>", "</s>", "<|end_of_text|>"]
+    @modal.fastapi_endpoint(method="POST")
 
-        )
+    def ask_web(
 
-        return {"answer": resp["choices"][0]["message"]["content"]}
+        self,
 
-    except Exception as e:
+        q: str = Form(""),
 
-        return {"error": str(e)}
+        system: str = Form(DEFAULT_SYSTEM_MESSAGE),
 
+        tokens: int = Form(TOKEN_LIMIT),
 
+        image_file: UploadFile = File(None),
 
-@app.function(
+        image_base64: str = Form(None)
 
-    image=image,
+    ):
 
-    volumes={"/models": volume},
+        messages = [{"role": "system", "content": system}]
 
-    gpu="L4", # Confirm GPU utilization as discussed
 
-    timeout=3600,
 
-    min_containers=0
+        img_bytes = None
 
-)
+        if image_file:
 
-def serve():
+            img_bytes = image_file.file.read()
 
-    llm = Llama(
+        elif image_base64:
 
-        model_path=MODEL_PATH,
+            img_bytes = base64.b64decode(image_base64)
 
-        n_ctx=4096,
 
-        n_gpu_layers=100, # Adjust based on your GPU setup and llama_cpp_python build
 
-        n_threads=os.cpu_count()
+        if img_bytes:
 
-    )
+            image_tag = f"<image>{base64.b64encode(img_bytes).decode()}</image>"
 
+            q += "\n" + image_tag
 
 
-    def llm_query(messages, max_tokens, image_data=None):
 
-        stop_tokens = ["<|im_end|>", "</s>", "<|end_of_text|>"]
+        messages.append({"role": "user", "content": q})
 
-        full = ""
+        try:
 
-       
+            request = self.engine.submit(messages, tokens, priority=PRIORITY_API)
 
-        chat_completion_args = {
+            answer = request.result(timeout=REQUEST_TIMEOUT)
 
-            "messages": messages,
+            return {
 
-            "stream": True,
+                "answer": answer,
 
-            "max_tokens": max_tokens,
+                "queued_seconds": round(request.started - request.submitted, 3),
 
-            "temperature": 0.7,
+                "first_token_seconds": round(request.first_token - request.started, 3) if request.first_token else None,
 
-            "top_p": 0.9,
+                "generation_seconds": round(time.perf_counter() - request.started, 3)
 
-            "repeat_penalty": 1.1,
+            }
 
-            "stop": stop_tokens
+        except Exception as e:
 
-        }
+            return {"error": str(e)}
+
+
+
+    @modal.web_server(7860, startup_timeout=600)
+
+    def ui(self):
+
+        # demo.queue().launch(server_name="0.0.0.0", server_port=7860, auth=("bawn", "password"), max_file_size="5MB")
+
+        # Gradio runs one event per listener at a time by default; let as many chats through as the
+
+        # engine queues, so concurrent users share its batches and the engine decides who waits
+
+        build_demo(self.engine).queue(default_concurrency_limit=MAX_QUEUED_REQUESTS).launch(server_name="0.0.0.0", server_port=7860, max_file_size="5MB", prevent_thread_lock=True)
+
+
+
+    @modal.method()
+
+    def chat(self, q: str, system: str = DEFAULT_SYSTEM_MESSAGE, tokens: int = TOKEN_LIMIT):
+
+        messages = [{"role": "system", "content": system}, {"role": "user", "content": q}]
+
+        return self.engine.submit(messages, tokens, priority=PRIORITY_API).result(timeout=REQUEST_TIMEOUT)
+
+
+
+    @modal.method()
+
+    def stats(self):
+
+        return self.engine.stats()
+
+
+
+@app.local_entrypoint()
+
+def load_test(concurrency: int = 8, tokens: int = 128):
+
+    # modal run modal-chatbot.py::load_test --concurrency 8
+
+    # Run again with BATCH_MAX_SIZE=1 in the environment for the unbatched baseline
+
+    bella = Bella()
+
+    before = bella.stats.remote()
+
+    prompts = [f"Write a short story about a robot called Unit {i}." for i in range(concurrency)]
+
+    started = time.perf_counter()
+
+    list(bella.chat.map(prompts, kwargs={"tokens": tokens}))
+
+    seconds = time.perf_counter() - started
+
+    after = bella.stats.remote()
+
+    generated = after["tokens"] - before["tokens"]
+
+    print(f"{concurrency} concurrent chats: {generated} tokens in {seconds:.1f}s, {generated / seconds:.1f} tokens/s")
+
+    print(f"Engine: {after['tokens_per_second']} tokens/s while decoding, mean batch size {after['mean_batch_size']}")
+
+
+
+def build_demo(engine):
+
+
+
+    def llm_query(messages, max_tokens, image_data=None, session_id=None):
+
+        full = ""
 
 
 
@@ -314,9 +440,9 @@ def serve():
 
 
 
-        for chunk in llm.create_chat_completion(**chat_completion_args):
+        for delta in engine.submit(messages, max_tokens, priority=PRIORITY_CHAT, session_id=session_id).stream():
 
-            full += chunk["choices"][0]["delta"].get("content", "")
+            full += delta
 
             yield full
 
@@ -324,7 +450,7 @@ def serve():
 
     # --- Modified chat_fn with safety rails and alerts ---
 
-    def chat_fn(message, history, max_tokens, system, image_input, pdf_input):
+    def chat_fn(message, history, max_tokens, system, image_input, pdf_input, request: gr.Request):
 
         new_history = history if history is not None else []
 
@@ -436,6 +562,8 @@ def serve():
 
 
 
+        # The full history is still sent; the engine only evaluates what this session has not seen
+
         messages = [{"role": "system", "content": system}] + new_history
 
         current_response_content = ""
@@ -444,7 +572,7 @@ def serve():
 
         try:
 
-            for chunk in llm_query(messages, max_tokens, image_data=image_data_to_llm):
+            for chunk in llm_query(messages, max_tokens, image_data=image_data_to_llm, session_id=request.session_hash):
 
                 current_response_content = chunk
 
@@ -598,16 +726,12 @@ def serve():
 
         clear_btn.click(lambda: ([], "", None, None), outputs=[chatbot, msg, image_input, pdf_input], queue=False)
 
-   
 
-    # demo.queue().launch(server_name="0.0.0.0", server_port=7860, auth=("bawn", "password"), max_file_size="5MB")
 
-    demo.queue().launch(server_name="0.0.0.0", server_port=7860,max_file_size="5MB", share="True")
+    return demo
 
 
 
 if __name__ == "__main__":
 
-    download_model.remote()
-
-    serve.remote()
\ No newline at end of file
+    download_model.remote()
\ No newline at end of file
@@ -0,0 +1,97 @@
+"""A stand-in for the parts of llama_cpp bella_engine's InferenceEngine uses.
+
+Each context records the tokens every sequence holds, so tests can check
+the engine's KV cache bookkeeping, and checks that every token is decoded
+at the next free position of its sequence and with a sequence id below
+n_seq_max. The "model" always answers token t with (t + 1) % N_VOCAB; token
+0 is end-of-sequence.
+"""
+import ctypes
+
+import numpy as np
+
+N_VOCAB = 50
+
+
+class Batch:
+    def __init__(self, n_tokens: int):
+        self.token = [0] * n_tokens
+        self.pos = [0] * n_tokens
+        self.n_seq_id = [0] * n_tokens
+        self.seq_id = [[0] for _ in range(n_tokens)]
+        self.logits = [False] * n_tokens
+        self.n_tokens = 0
+
+
+class Context:
+    """Plays both Llama._ctx and the raw context pointer (Llama._ctx.ctx)."""
+
+    def __init__(self, n_seq_max: int):
+        self.ctx = self
+        self.n_seq_max = n_seq_max
+        self.kv = {}  # seq_id -> tokens it holds
+        self.decodes = []  # n_tokens of every llama_decode call
+        self.copies = []  # (src, dst, n_tokens) of every kv_cache_seq_cp call
+        self.logits = []
+
+    def kv_cache_clear(self):
+        self.kv.clear()
+
+    def kv_cache_seq_rm(self, seq_id: int, p0: int, p1: int):
+        if p0 < 0:
+            self.kv.pop(seq_id, None)
+        else:
+            self.kv[seq_id] = self.kv.get(seq_id, [])[:p0]
+
+    def kv_cache_seq_cp(self, src: int, dst: int, p0: int, p1: int):
+        tokens = self.kv.get(src, [])[:p1 if p1 >= 0 else None]
+        self.copies.append((src, dst, len(tokens)))
+        self.kv[dst] = list(tokens)
+
+
+def llama_n_seq_max(ctx: Context) -> int:
+    return ctx.n_seq_max
+
+
+def llama_batch_init(n_tokens: int, embd: int, n_seq_max: int) -> Batch:
+    return Batch(n_tokens)
+
+
+def llama_decode(ctx: Context, batch: Batch) -> int:
+    ctx.decodes.append(batch.n_tokens)
+    ctx.logits = []
+    for i in range(batch.n_tokens):
+        seq_id = batch.seq_id[i][0]
+        assert 0 <= seq_id < ctx.n_seq_max, f"seq_id {seq_id} outside n_seq_max {ctx.n_seq_max}"
+        tokens = ctx.kv.setdefault(seq_id, [])
+        assert batch.pos[i] == len(tokens), f"seq {seq_id}: token at {batch.pos[i]}, cache holds {len(tokens)}"
+        tokens.append(batch.token[i])
+        logits = np.full(N_VOCAB, -10.0, dtype=np.float32)
+        logits[(batch.token[i] + 1) % N_VOCAB] = 10.0
+        ctx.logits.append(logits)
+    return 0
+
+
+def llama_get_logits_ith(ctx: Context, i: int):
+    return ctx.logits[i].ctypes.data_as(ctypes.POINTER(ctypes.c_float))
+
+
+class Llama:
+    n_batch = 8
+
+    def __init__(self, n_seq_max: int):
+        self._ctx = Context(n_seq_max)
+
+    def n_vocab(self) -> int:
+        return N_VOCAB
+
+    def token_eos(self) -> int:
+        return 0
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False) -> list:
+        if text == b"<|im_end|>":
+            return [0]
+        return [1 + byte % (N_VOCAB - 5) for byte in text][:40]
+
+    def detokenize(self, tokens: list) -> bytes:
+        return "".join(chr(ord("A") + t % 26) for t in tokens).encode()
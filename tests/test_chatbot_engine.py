@@ -0,0 +1,141 @@
+"""Scheduling and KV cache bookkeeping of bella_engine's InferenceEngine.
+
+    pip install -r requirements-test.txt
+    python -m unittest tests.test_chatbot_engine
+
+The engine drives llama_cpp's low-level API; tests.fake_llama_cpp stands
+in for it.
+"""
+import hashlib
+import sys
+import time
+import unittest
+from unittest import mock
+
+from tests import fake_llama_cpp
+
+with mock.patch.dict(sys.modules, {"llama_cpp": fake_llama_cpp}):
+    import bella_engine
+
+
+def wait_until(condition, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("condition not met in time")
+        time.sleep(0.005)
+
+
+def conversation(system: str, *turns: str) -> list:
+    messages = [{"role": "system", "content": system}] if system else []
+    return messages + [{"role": "user", "content": turn} for turn in turns]
+
+
+class InferenceEngineTest(unittest.TestCase):
+    def make_engine(self, batch_size: int = 4, **settings):
+        for name, value in settings.items():
+            patcher = mock.patch.object(bella_engine, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.llm = fake_llama_cpp.Llama(bella_engine.sequences_needed(batch_size))
+        return bella_engine.InferenceEngine(self.llm, batch_size=batch_size, batch_wait_ms=20)
+
+    def idle(self, engine):
+        # the worker releases a finished sequence just after its last output
+        wait_until(lambda: len(engine._free_seq_ids) == engine.batch_size)
+
+    def test_context_without_enough_sequences_is_refused(self):
+        # the fake's llama_decode would only fail once a cached sequence is used
+        llm = fake_llama_cpp.Llama(n_seq_max=1)
+        with self.assertRaises(ValueError):
+            bella_engine.InferenceEngine(llm, batch_size=4)
+
+    def test_batch_size_does_not_change_output(self):
+        outputs, decodes = {}, {}
+        for batch_size in (1, 4):
+            engine = self.make_engine(batch_size)
+            requests = [engine.submit(conversation(None, f"question {i}"), 30) for i in range(6)]
+            outputs[batch_size] = [r.result(timeout=10) for r in requests]
+            decodes[batch_size] = len(self.llm._ctx.decodes)
+        self.assertEqual(outputs[1], outputs[4])
+        self.assertTrue(all(outputs[1]))
+        # decoding four conversations per llama_decode call takes fewer calls
+        self.assertLess(decodes[4], decodes[1])
+
+    def test_cancelled_request_frees_its_sequence(self):
+        engine = self.make_engine(batch_size=2)
+        stream = engine.submit(conversation(None, "tell me everything"), 1000).stream()
+        next(stream)
+        stream.close()  # cancels, as when the browser goes away
+        self.assertTrue(engine.submit(conversation(None, "next"), 3).result(timeout=5))
+        self.idle(engine)
+        self.assertEqual(sorted(engine._free_seq_ids), [0, 1])
+        self.assertFalse([s for s, tokens in self.llm._ctx.kv.items() if s < 2 and tokens])
+
+    def test_system_prompt_is_evaluated_once(self):
+        engine = self.make_engine(batch_size=2)
+        first = engine.submit(conversation("You are Bella", "hi"), 5).result(timeout=5)
+        evaluated = sum(self.llm._ctx.decodes)
+        second = engine.submit(conversation("You are Bella", "hi"), 5).result(timeout=5)
+        self.assertEqual(first, second)
+        stats = engine.stats()
+        self.assertEqual((stats["prefix_hits"], stats["prefix_misses"]), (1, 1))
+        # the second request copied the cached prompt instead of evaluating it again
+        prefix_seq_id, n_prefix, _ = next(iter(engine._prefixes._entries.values()))
+        self.assertIn((prefix_seq_id, n_prefix), [(src, n) for src, _, n in self.llm._ctx.copies])
+        self.assertEqual(sum(self.llm._ctx.decodes) - evaluated, evaluated - n_prefix)
+
+    def test_prefix_cache_drops_least_recently_used(self):
+        engine = self.make_engine(batch_size=2, PREFIX_CACHE_SLOTS=2)
+        for system in ("A", "B", "A", "C"):
+            engine.submit(conversation(system, "q"), 3).result(timeout=5)
+        self.idle(engine)
+        keys = [hashlib.sha256(bella_engine.chatml(conversation(s))[0].encode()).hexdigest() for s in "AC"]
+        self.assertEqual(list(engine._prefixes._entries), keys)
+        cached = {seq_id for seq_id, _, _ in engine._prefixes._entries.values()}
+        self.assertEqual(cached | set(engine._prefixes._free_seq_ids), {2, 3})
+        # B's sequence was removed from the KV cache when it was dropped
+        held = {s for s, tokens in self.llm._ctx.kv.items() if tokens}
+        self.assertEqual(held, cached)
+
+    def test_session_turn_evaluates_only_new_tokens(self):
+        engine = self.make_engine(batch_size=2)
+        history = conversation("You are Bella")
+        cached = []
+        for turn in range(4):
+            history.append({"role": "user", "content": f"question {turn}"})
+            before = sum(self.llm._ctx.decodes)
+            answer = engine.submit(history, 6, session_id="s1").result(timeout=5)
+            self.idle(engine)
+            history.append({"role": "assistant", "content": answer})
+            tokens, _ = engine._sessions._entries["s1"][2]
+            # only what follows the tokens shared with the previous turn was evaluated; the
+            # fake's position check fails if the session's copy into the new sequence was wrong
+            reused = bella_engine.common_prefix_length(cached, tokens)
+            self.assertEqual(sum(self.llm._ctx.decodes) - before, len(tokens) - reused)
+            self.assertEqual(bool(reused), bool(turn))
+            cached = tokens
+        stats = engine.stats()
+        self.assertEqual((stats["session_hits"], stats["session_misses"]), (3, 1))
+        # taking the session frees its slot for the turn, storing it takes one again
+        self.assertEqual(len(engine._sessions._entries), 1)
+        self.assertEqual(len(engine._sessions._free_seq_ids), bella_engine.SESSION_CACHE_SLOTS - 1)
+
+    def test_session_window_drops_old_turns(self):
+        engine = self.make_engine(batch_size=2, CONTEXT_PER_SEQUENCE=200)
+        history = conversation("You are Bella")
+        for turn in range(10):
+            history.append({"role": "user", "content": f"question {turn} " * 3})
+            answer = engine.submit(history, 6, session_id="s1").result(timeout=5)
+            history.append({"role": "assistant", "content": answer})
+        self.idle(engine)
+        n_cached, (_, first_turn) = engine._sessions._entries["s1"][1:]
+        self.assertGreater(first_turn, 0)
+        self.assertLessEqual(n_cached, 200)
+        # a single turn that cannot fit next to max_tokens is refused
+        with self.assertRaises(ValueError):
+            engine.submit(conversation(None, "too long"), 195).result(timeout=5)
+
+
+if __name__ == "__main__":
+    unittest.main()